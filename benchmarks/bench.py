@@ -0,0 +1,393 @@
+"""Throughput and latency benchmarks for scope and the viewer server.
+
+python benchmarks/bench.py --output results.json
+python benchmarks/bench.py --only reader --rows 1e6,1e7,1e8
+python benchmarks/bench.py --output new.json --compare results.json
+"""
+
+import argparse
+import contextlib
+import functools
+import io
+import json
+import os
+import pathlib
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+import scope
+
+BENCHMARKS = {}
+
+
+def benchmark(fn):
+    BENCHMARKS[fn.__name__] = fn
+    return fn
+
+
+def measure(fn, repeat):
+    # Returns the durations of the first call and of the repeated calls.
+    durations = []
+    for _ in range(repeat + 1):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    return durations[0], durations[1:]
+
+
+def result(name, params, seconds, **metrics):
+    return {
+        'name': name + ''.join(f'/{k}={v}' for k, v in params.items()),
+        'params': params,
+        'seconds': seconds,
+        **metrics,
+    }
+
+
+@benchmark
+def writer(args, tmpdir):
+    fmts = {
+        'float': (scope.formats.Float(), lambda step: float(step)),
+        'cfloat': (scope.formats.CompressedFloat(), lambda step: float(step)),
+        'text': (scope.formats.Text(packed=True), lambda step: f'{step}'),
+    }
+    for fmt_name, (fmt, make) in fmts.items():
+        for keys in (1, 10, 100, 1000):
+            steps = max(20, args.writer_rows // keys)
+            names = [f'key{i}' for i in range(keys)]
+            logdir = pathlib.Path(tmpdir, f'writer-{fmt_name}-{keys}')
+            writer = scope.Writer(logdir, formats=[fmt])
+            add = flush = 0.0
+            start = time.perf_counter()
+            for step in range(steps):
+                value = make(step)
+                mapping = {name: value for name in names}
+                t = time.perf_counter()
+                writer.add(step, mapping)
+                add += time.perf_counter() - t
+                if step % 10 == 9:
+                    t = time.perf_counter()
+                    writer.flush()
+                    flush += time.perf_counter() - t
+            writer.close()
+            seconds = time.perf_counter() - start
+            rows = steps * keys
+            params = {'format': fmt_name, 'keys': keys}
+            yield result(
+                'writer',
+                params,
+                seconds,
+                rows=rows,
+                rows_per_second=rows / seconds,
+                add_seconds=add,
+                flush_seconds=flush,
+            )
+
+
+@benchmark
+def reader(args, tmpdir):
+    for rows in args.rows:
+        logdir = pathlib.Path(tmpdir, f'reader-{rows}')
+        columns = logdir / 'scope'
+        columns.mkdir(parents=True)
+        chunk = int(1e7)
+        for fmt in (scope.formats.Float(), scope.formats.CompressedFloat()):
+            path = columns / f'{fmt.extension}.{fmt.extension}'
+            fmt.create(path)
+            for start in range(0, rows, chunk):
+                steps = np.arange(start, min(start + chunk, rows))
+                fmt.write(path, steps, np.sin(steps / 1000))
+        reader = scope.Reader(logdir)
+        for key in ('float', 'cfloat'):
+            nbytes = 0
+            if key == 'float':
+                nbytes = (columns / 'float.float').stat().st_size
+            cases = {
+                'full': functools.partial(reader.__getitem__, key),
+                'tail': functools.partial(reader.read, key, -1000),
+                'steps': functools.partial(
+                    reader.read_steps, key, rows // 2, rows // 2 + 1000
+                ),
+                'summary': functools.partial(reader.summary, key, 1000),
+            }
+            for case, fn in cases.items():
+                repeat = 1 if case in ('full', 'summary') else args.repeat
+                _, durations = measure(fn, repeat)
+                seconds = min(durations)
+                metrics = {}
+                if case == 'full':
+                    metrics['rows_per_second'] = rows / seconds
+                    if nbytes:
+                        metrics['bytes_per_second'] = nbytes / seconds
+                params = {'format': key, 'rows': rows, 'case': case}
+                yield result('reader', params, seconds, **metrics)
+        path = columns / 'float.float'
+        _, durations = measure(
+            functools.partial(scope.formats.table_read, path, '>qd'), 1
+        )
+        seconds = min(durations)
+        yield result(
+            'table_read',
+            {'rows': rows},
+            seconds,
+            rows_per_second=rows / seconds,
+            bytes_per_second=path.stat().st_size / seconds,
+        )
+
+
+@benchmark
+def media(args, tmpdir):
+    rng = np.random.default_rng(0)
+    # Smooth gradients with noise compress similarly to rendered frames.
+    y, x = np.mgrid[:256, :256]
+    image = np.stack([x, y, (x + y) // 2], -1).astype(np.uint8)
+    image = image + rng.integers(0, 16, image.shape, np.uint8)
+    fmts = {
+        'png': scope.formats.Image('png'),
+        'jpg': scope.formats.Image('jpg'),
+    }
+    for name, fmt in fmts.items():
+        buffer = fmt.encode(image)
+        for op, fn in (
+            ('encode', functools.partial(fmt.encode, image)),
+            ('decode', functools.partial(fmt.decode, buffer)),
+        ):
+            _, durations = measure(fn, args.repeat * 10)
+            seconds = statistics.median(durations)
+            params = {
+                'format': name,
+                'op': op,
+                'shape': 'x'.join(str(x) for x in image.shape),
+            }
+            yield result(
+                'media', params, seconds, items_per_second=1 / seconds
+            )
+    video = np.stack([np.roll(image[:128, :128], i, 1) for i in range(64)])
+    fmt = scope.formats.Video()
+    buffer = fmt.encode(video)
+    for op, fn in (
+        ('encode', lambda: fmt.encode(video)),
+        ('decode', lambda: fmt.decode(buffer)),
+        ('poster', lambda: fmt.decode(buffer, frames=1)),
+    ):
+        _, durations = measure(fn, args.repeat)
+        seconds = statistics.median(durations)
+        frames = 1 if op == 'poster' else len(video)
+        params = {
+            'format': 'mp4',
+            'op': op,
+            'shape': 'x'.join(str(x) for x in video.shape),
+        }
+        yield result(
+            'media', params, seconds, frames_per_second=frames / seconds
+        )
+
+
+@benchmark
+def server(args, tmpdir):
+    basedir = pathlib.Path(tmpdir, 'runs')
+    rows = args.server_rows
+    for run in range(4):
+        writer = scope.Writer(basedir / 'exp' / f'run{run}', workers=0)
+        image = np.zeros((64, 64, 3), np.uint8)
+        writer.add(0, {'image': image, 'text': 'hello'})
+        for key in range(20):
+            steps = np.arange(rows)
+            path = writer.logdir / f'key{key}.float'
+            scope.formats.table_append(path, '>qd', steps, np.cos(steps))
+        writer.close()
+    sys.argv = [
+        sys.argv[0],
+        '--basedir',
+        str(basedir),
+        '--filesystem',
+        'local',
+        '--catalog',
+        str(pathlib.Path(tmpdir, 'catalog.sqlite')),
+        '--cachedir',
+        str(pathlib.Path(tmpdir, 'cache')),
+    ]
+    with contextlib.redirect_stdout(io.StringIO()):
+        from fastapi.testclient import TestClient
+
+        from scope_viewer import server
+
+        import colcache
+        import filesystems
+
+    cols = [f'exp:run0:scope:key{i}.float' for i in range(20)]
+    requests = {
+        'exps': ('get', '/api/exps', {}),
+        'exp': ('get', '/api/exp/exp', {}),
+        'run': ('get', '/api/run/exp:run0', {}),
+        'col': ('get', f'/api/col/{cols[0]}', {}),
+        'col_bin': ('get', f'/api/col/{cols[0]}?format=bin', {}),
+        'col_delta': ('get', f'/api/col/{cols[0]}?offset={rows - 10}', {}),
+        'cols': ('post', '/api/cols', {'json': {'cols': cols}}),
+        'cols_bin': (
+            'post',
+            '/api/cols',
+            {'json': {'cols': cols, 'format': 'bin'}},
+        ),
+        'agg': (
+            'get',
+            '/api/agg?cols='
+            + ','.join(f'exp:run{i}:scope:key0.float' for i in range(4)),
+            {},
+        ),
+        'image': ('get', None, {}),
+    }
+    backends = {
+        'local': filesystems.Local(),
+        'elements': remote(filesystems, args.latency),
+        'fileutil': filesystems.Fileutil(**fileutil(args.latency)),
+    }
+    for backend, fs in backends.items():
+        # Replace the storage of the server so that every backend starts with
+        # cold caches.
+        server.fs = fs
+        server.listfs = filesystems.WithListCache(fs, 30, 3600)
+        server.columns = colcache.ColumnCache(fs, int(1e9))
+        if backend == 'local':
+            server.cachedfs = fs
+        else:
+            cachedir = pathlib.Path(tmpdir, f'cache-{backend}')
+            server.cachedfs = filesystems.WithFileCache(fs, cachedir, 1e9)
+        client = TestClient(server.app)
+        for name, (method, url, kwargs) in requests.items():
+            if name == 'image':
+                with contextlib.redirect_stdout(io.StringIO()):
+                    response = client.get('/api/col/exp:run0:scope:image.png')
+                url = '/api/file/' + response.json()['values'][0]
+            fn = functools.partial(fetch, client, method, url, kwargs)
+            with contextlib.redirect_stdout(io.StringIO()):
+                cold, durations = measure(fn, args.repeat * 5)
+            params = {'backend': backend, 'endpoint': name}
+            yield result(
+                'server',
+                params,
+                statistics.median(durations),
+                cold_seconds=cold,
+                p90_seconds=float(np.percentile(durations, 90)),
+            )
+
+
+def fetch(client, method, url, kwargs):
+    response = getattr(client, method)(url, **kwargs)
+    assert response.status_code == 200, (url, response.text)
+
+
+def remote(filesystems, latency):
+    # Stand-in for remote storage with a fixed round trip per call, run on a
+    # thread pool like the Elements backend.
+
+    class Remote(filesystems.Async):
+        def __init__(self):
+            self.local = filesystems.Local()
+
+        def list(self, path):
+            time.sleep(latency)
+            return self.local.list(path)
+
+        def size(self, path):
+            time.sleep(latency)
+            return self.local.size(path)
+
+        def read(self, path):
+            time.sleep(latency)
+            return self.local.read(path)
+
+        def open(self, path, seek=0, limit=None):
+            time.sleep(latency)
+            return self.local.open(path, seek, limit)
+
+    return Remote()
+
+
+def fileutil(latency):
+    # Shell commands for the Fileutil backend that read local files after a
+    # delay, so that the subprocess overhead is part of the measurement.
+    delay = f'sleep {latency} &&'
+    return {
+        'ls': f'{delay} ls -d {{}}/* | cat',
+        'cat': f'{delay} cat {{}} | cat',
+        'size': f'{delay} stat -c %s {{}} | cat',
+        'catrange': (
+            f'{delay} tail -c +$(({{0}} + 1)) {{2}} | head -c $(({{1}} - {{0}}))'
+        ),
+    }
+
+
+def metadata():
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=pathlib.Path(__file__).parent,
+            stderr=subprocess.DEVNULL,
+        )
+        commit = commit.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'argv': sys.argv[1:],
+    }
+
+
+def compare(results, baseline):
+    # Prints the ratio of the durations of matching benchmarks, where values
+    # above one are slower than the baseline.
+    before = {x['name']: x['seconds'] for x in baseline['results']}
+    for entry in results:
+        if entry['name'] not in before:
+            continue
+        ratio = entry['seconds'] / max(before[entry['name']], 1e-12)
+        flag = ' slower' if ratio > 1.2 else ' faster' if ratio < 0.8 else ''
+        print(f'{ratio:6.2f}x {entry["name"]}{flag}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--output', default='benchmarks/results.json')
+    parser.add_argument('--compare', default=None)
+    parser.add_argument('--only', default=','.join(BENCHMARKS))
+    parser.add_argument('--rows', default='1e6,1e7')
+    parser.add_argument('--writer_rows', type=float, default=1e5)
+    parser.add_argument('--server_rows', type=float, default=1e5)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--tmpdir', default=None)
+    args = parser.parse_args()
+    args.rows = [int(float(x)) for x in args.rows.split(',')]
+    args.writer_rows = int(args.writer_rows)
+    args.server_rows = int(args.server_rows)
+    meta = metadata()
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.tmpdir) as tmpdir:
+        for name in args.only.split(','):
+            print(f'Running {name}', flush=True)
+            for entry in BENCHMARKS[name](args, tmpdir):
+                print(f'{entry["seconds"]:10.6f}s {entry["name"]}', flush=True)
+                results.append(entry)
+    output = {'meta': meta, 'results': results}
+    pathlib.Path(args.output).write_text(json.dumps(output, indent=2))
+    print(f'Wrote {len(results)} results to {args.output}')
+    if args.compare:
+        compare(results, json.loads(pathlib.Path(args.compare).read_text()))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,4 @@
+from . import formats, pyramid
+from .formats import table_append, table_read
 from .reader import Reader
 from .writer import Writer
-
-from .formats import table_read
-from .formats import table_append
-
-from . import formats
@@ -1,12 +1,35 @@
 import io
+import re
 import struct
 import time
+import zlib
 
 import numpy as np
 import PIL.Image
 
+from . import pyramid
+
+TABLE_TYPES = {
+    '?': 'b1',
+    'b': 'i1',
+    'B': 'u1',
+    'h': 'i2',
+    'H': 'u2',
+    'i': 'i4',
+    'I': 'u4',
+    'q': 'i8',
+    'Q': 'u8',
+    'e': 'f2',
+    'f': 'f4',
+    'd': 'f8',
+}
+
 
 class Float:
+    def __init__(self, mmap=False, pyramid=False):
+        self.mmap = mmap
+        self.pyramid = pyramid
+
     @property
     def extension(self):
         return 'float'
@@ -22,22 +45,170 @@ class Float:
         return np.asarray(x, np.float64)
 
     def create(self, path):
-        pass
+        if self.pyramid:
+            pyramid.create(path)
 
     def write(self, path, steps, values):
         table_append(path, '>qd', steps, values)
-
-    def read(self, path):
-        steps, values = table_read(path, '>qd')
-        steps = np.int64(steps)
-        values = np.float64(values)
+        if self.pyramid:
+            stop = table_length(path, '>qd')
+            pyramid.update(path, stop - len(steps), stop)
+
+    def read(self, path, start=0, stop=None):
+        steps, values = table_read(path, '>qd', start, stop, self.mmap)
+        if not self.mmap:
+            steps = steps.astype(np.int64)
+            values = values.astype(np.float64)
         return steps, values
 
     def length(self, path):
         return table_length(path, '>qd')
 
+    def bisect(self, path, step):
+        return table_bisect(path, '>qd', step)
+
+    def summary(self, path, points, start=0, stop=None):
+        if pyramid.exists(path):
+            return pyramid.read(path, points, start, stop)
+        steps, values = self.read(path, start, stop)
+        return pyramid.summarize(steps, values, points)
+
+
+class CompressedFloat:
+    # Stores fixed-size blocks of rows compressed with delta-of-delta steps
+    # and XOR-ed values, whose bytes are shuffled into planes and deflated.
+    # Rows of the unfinished block are kept uncompressed in a tail table
+    # together with their row number, so that readers skip rows that were
+    # already moved into a block.
+
+    def __init__(self, block=4096, level=6):
+        self.block = block
+        self.level = level
+
+    @property
+    def extension(self):
+        return 'cfloat'
+
+    def valid(self, x):
+        if isinstance(x, (int, float)):
+            return True
+        if isinstance(x, np.ndarray):
+            return x.ndim == 0 and np.isreal(x)
+        return False
+
+    def convert(self, x):
+        return np.asarray(x, np.float64)
+
+    def create(self, path):
+        path.mkdir(exist_ok=True)
+
+    def write(self, path, steps, values):
+        index = self._index(path, -1)
+        covered = int(index[1][0] + index[2][0]) if len(index[0]) else 0
+        offset = int(index[3][0] + index[4][0]) if len(index[0]) else 0
+        tail = self._tail(path, covered)
+        steps = np.concatenate([tail[0], np.asarray(steps, np.int64)])
+        values = np.concatenate([tail[1], np.asarray(values, np.float64)])
+        if len(steps) < self.block:
+            rows = np.arange(covered + len(tail[0]), covered + len(steps))
+            new = len(tail[0])
+            table_append(
+                path / 'tail', '>qqd', rows, steps[new:], values[new:]
+            )
+            return
+        full = len(steps) // self.block * self.block
+        starts = np.arange(0, full, self.block)
+        buffers = [
+            compressed_encode(
+                steps[i : i + self.block],
+                values[i : i + self.block],
+                self.level,
+            )
+            for i in starts
+        ]
+        lengths = [len(x) for x in buffers]
+        offsets = offset + np.cumsum([0] + lengths[:-1])
+        with (path / 'blocks').open('ab') as f:
+            for buffer in buffers:
+                f.write(buffer)
+        table_append(
+            path / 'index',
+            '>qqqqq',
+            steps[starts],
+            covered + starts,
+            [self.block] * len(starts),
+            offsets,
+            lengths,
+        )
+        rows = np.arange(covered + full, covered + len(steps))
+        buffer = table_pack('>qqd', rows, steps[full:], values[full:])
+        (path / 'tail').write_bytes(buffer)
+
+    def read(self, path, start=0, stop=None):
+        _, starts, sizes, offsets, lengths = self._index(path)
+        covered = int(starts[-1] + sizes[-1]) if len(starts) else 0
+        first = max(0, int(np.searchsorted(starts, start, 'right')) - 1)
+        last = len(starts) if stop is None else np.searchsorted(starts, stop)
+        parts = []
+        if first < last:
+            lo = int(offsets[first])
+            hi = int(offsets[last - 1] + lengths[last - 1])
+            with (path / 'blocks').open('rb') as f:
+                f.seek(lo)
+                buffer = f.read(hi - lo)
+            for i in range(first, last):
+                begin = int(offsets[i]) - lo
+                end = begin + int(lengths[i])
+                parts.append(compressed_decode(buffer[begin:end], sizes[i]))
+        if stop is None or stop > covered:
+            parts.append(self._tail(path, covered))
+        steps = np.concatenate([np.zeros(0, np.int64), *[x[0] for x in parts]])
+        values = np.concatenate([np.zeros(0), *[x[1] for x in parts]])
+        offset = int(starts[first]) if first < last else covered
+        stop = None if stop is None else max(0, stop - offset)
+        window = slice(max(0, start - offset), stop)
+        return steps[window], values[window]
+
+    def length(self, path):
+        index = self._index(path, -1)
+        covered = int(index[1][0] + index[2][0]) if len(index[0]) else 0
+        return covered + len(self._tail(path, covered)[0])
+
+    def bisect(self, path, step):
+        index = self._index(path)
+        block = int(np.searchsorted(index[0], step)) - 1
+        if block < 0 and len(index[0]):
+            return 0
+        lo = int(index[1][block]) if block >= 0 else 0
+        hi = int(index[1][block + 1]) if block + 1 < len(index[0]) else None
+        steps, _ = self.read(path, lo, hi)
+        return lo + int(np.searchsorted(steps, step))
+
+    def summary(self, path, points, start=0, stop=None):
+        steps, values = self.read(path, start, stop)
+        return pyramid.summarize(steps, values, points)
+
+    def _index(self, path, start=0):
+        filename = path / 'index'
+        if not filename.exists():
+            return tuple(np.zeros(0, np.int64) for _ in range(5))
+        if start < 0:
+            start = max(0, table_length(filename, '>qqqqq') + start)
+        return table_read(filename, '>qqqqq', start)
+
+    def _tail(self, path, covered):
+        filename = path / 'tail'
+        if not filename.exists():
+            return np.zeros(0, np.int64), np.zeros(0, np.float64)
+        rows, steps, values = table_read(filename, '>qqd')
+        mask = rows >= covered
+        return steps[mask].astype(np.int64), values[mask].astype(np.float64)
+
 
 class Text:
+    def __init__(self, packed=False):
+        self.packed = packed
+
     @property
     def extension(self):
         return 'txt'
@@ -51,26 +222,31 @@ class Text:
     def create(self, path):
         path.mkdir(exist_ok=True)
 
-    def write(self, path, steps, values):
-        files_write(path, steps, values, self.encode)
+    def write(self, path, steps, values, encoded=False):
+        encode = None if encoded else self.encode
+        files_write(path, steps, values, encode, self.packed)
 
-    def read(self, path):
-        return files_read(path)
+    def read(self, path, start=0, stop=None):
+        return files_read(path, start, stop)
 
     def encode(self, value):
         return value.encode('utf-8')
 
     def decode(self, buffer):
-        return buffer.deceode('utf-8')
+        return buffer.decode('utf-8')
 
     def length(self, path):
         return files_length(path)
 
+    def bisect(self, path, step):
+        return files_bisect(path, step)
+
 
 class Image:
-    def __init__(self, ext='png', quality=90):
+    def __init__(self, ext='png', quality=90, packed=False):
         self.ext = ext
         self.quality = quality
+        self.packed = packed
 
     @property
     def extension(self):
@@ -90,11 +266,12 @@ class Image:
     def create(self, path):
         path.mkdir(exist_ok=True)
 
-    def write(self, path, steps, values):
-        files_write(path, steps, values, self.encode)
+    def write(self, path, steps, values, encoded=False):
+        encode = None if encoded else self.encode
+        files_write(path, steps, values, encode, self.packed)
 
-    def read(self, path):
-        return files_read(path)
+    def read(self, path, start=0, stop=None):
+        return files_read(path, start, stop)
 
     def encode(self, value):
         if value.shape[-1] == 1:
@@ -110,12 +287,16 @@ class Image:
     def length(self, path):
         return files_length(path)
 
+    def bisect(self, path, step):
+        return files_bisect(path, step)
+
 
 class Video:
-    def __init__(self, ext='mp4', codec='h264', fps=10):
+    def __init__(self, ext='mp4', codec='h264', fps=10, packed=False):
         self.ext = ext
         self.codec = codec
         self.fps = fps
+        self.packed = packed
 
     @property
     def extension(self):
@@ -135,39 +316,30 @@ class Video:
     def create(self, path):
         path.mkdir(exist_ok=True)
 
-    def write(self, path, steps, values):
-        files_write(path, steps, values, self.encode)
+    def write(self, path, steps, values, encoded=False):
+        encode = None if encoded else self.encode
+        files_write(path, steps, values, encode, self.packed)
 
-    def read(self, path):
-        return files_read(path)
+    def read(self, path, start=0, stop=None):
+        return files_read(path, start, stop)
 
     def encode(self, value):
-        import av
+        stream = self.stream()
+        stream.add(value)
+        return stream.close()
 
-        if value.shape[-1] == 1:
-            value = value.repeat(3, -1)
-        T, H, W, _ = value.shape
-        fp = io.BytesIO()
-        output = av.open(fp, mode='w', format=self.ext)
-        stream = output.add_stream(self.codec, rate=self.fps)
-        stream.width = W
-        stream.height = H
-        stream.pix_fmt = 'yuv420p'
-        for t in range(T):
-            frame = av.VideoFrame.from_ndarray(value[t], format='rgb24')
-            frame.pts = t
-            output.mux(stream.encode(frame))
-        output.mux(stream.encode(None))
-        output.close()
-        return fp.getvalue()
+    def stream(self):
+        return VideoStream(self.ext, self.codec, self.fps)
 
-    def decode(self, buffer):
+    def decode(self, buffer, frames=None):
         import av
 
         container = av.open(io.BytesIO(buffer))
         value = []
         for frame in container.decode(video=0):
             value.append(frame.to_ndarray(format='rgb24'))
+            if len(value) == frames:
+                break
         value = np.stack(value)
         container.close()
         return value
@@ -175,11 +347,44 @@ class Video:
     def length(self, path):
         return files_length(path)
 
+    def bisect(self, path, step):
+        return files_bisect(path, step)
+
+
+class VideoStream:
+    def __init__(self, ext, codec, fps):
+        import av
+
+        self.fp = io.BytesIO()
+        self.output = av.open(self.fp, mode='w', format=ext)
+        self.stream = self.output.add_stream(codec, rate=fps)
+        self.stream.pix_fmt = 'yuv420p'
+        self.t = 0
+
+    def add(self, frames):
+        import av
+
+        if frames.shape[-1] == 1:
+            frames = frames.repeat(3, -1)
+        if not self.t:
+            self.stream.height, self.stream.width = frames.shape[1:3]
+        for value in frames:
+            frame = av.VideoFrame.from_ndarray(value, format='rgb24')
+            frame.pts = self.t
+            self.output.mux(self.stream.encode(frame))
+            self.t += 1
+
+    def close(self):
+        self.output.mux(self.stream.encode(None))
+        self.output.close()
+        return self.fp.getvalue()
+
 
 class MediapyVideo:
-    def __init__(self, ext='mp4', fps=10):
+    def __init__(self, ext='mp4', fps=10, packed=False):
         self.ext = ext
         self.fps = fps
+        self.packed = packed
 
     @property
     def extension(self):
@@ -201,11 +406,12 @@ class MediapyVideo:
     def create(self, path):
         path.mkdir(exist_ok=True)
 
-    def write(self, path, steps, values):
-        files_write(path, steps, values, self.encode)
+    def write(self, path, steps, values, encoded=False):
+        encode = None if encoded else self.encode
+        files_write(path, steps, values, encode, self.packed)
 
-    def read(self, path):
-        return files_read(path)
+    def read(self, path, start=0, stop=None):
+        return files_read(path, start, stop)
 
     def encode(self, value):
         import mediapy
@@ -220,56 +426,192 @@ class MediapyVideo:
     def length(self, path):
         return files_length(path)
 
+    def bisect(self, path, step):
+        return files_bisect(path, step)
+
+
+def compressed_encode(steps, values, level=6):
+    steps = np.asarray(steps, np.int64)
+    values = np.asarray(values, np.float64)
+    deltas = np.diff(np.diff(steps, prepend=0), prepend=0).astype('<i8')
+    bits = values.astype('<f8').view('<u8')
+    xored = bits ^ np.concatenate([np.zeros(1, '<u8'), bits[:-1]])
+    planes = [x.view(np.uint8).reshape(-1, 8).T for x in (deltas, xored)]
+    return zlib.compress(b''.join(x.tobytes() for x in planes), level)
+
+
+def compressed_decode(buffer, rows):
+    planes = np.frombuffer(zlib.decompress(buffer), np.uint8)
+    planes = planes.reshape(2, 8, rows).transpose(0, 2, 1).copy()
+    deltas, xored = planes[0].view('<i8')[:, 0], planes[1].view('<u8')[:, 0]
+    steps = np.cumsum(np.cumsum(deltas)).astype(np.int64)
+    values = np.bitwise_xor.accumulate(xored).view('<f8').astype(np.float64)
+    return steps, values
+
 
 def table_append(filename, fmt, *cols):
-    rows = tuple(zip(*cols))
-    size = struct.calcsize(fmt)
-    buffer = bytearray(len(rows) * size)
-    for index, row in enumerate(rows):
-        struct.pack_into(fmt, buffer, index * size, *row)
+    buffer = table_pack(fmt, *cols)
     with filename.open('ab') as f:
         f.write(buffer)
 
 
-def table_read(filename, fmt, start=0, stop=None):
-    assert stop is None or start < stop, (start, stop)
-    if start == 0 and stop is None:
-        buffer = filename.read_bytes()
+def table_pack(fmt, *cols):
+    dtype = table_dtype(fmt)
+    table = np.empty(len(cols[0]), dtype)
+    for name, col in zip(dtype.names, cols):
+        table[name] = col
+    return table.tobytes()
+
+
+def table_read(filename, fmt, start=0, stop=None, mmap=False):
+    assert stop is None or start <= stop, (start, stop)
+    dtype = table_dtype(fmt)
+    if mmap:
+        # Views into the file without copying, in the byte order of the file.
+        count = filename.stat().st_size // dtype.itemsize
+        if not count:
+            return tuple(np.zeros(0, dtype[i]) for i in range(len(dtype)))
+        table = np.memmap(filename, dtype, 'r', shape=(count,))[start:stop]
     else:
-        size = struct.calcsize(fmt)
-        with filename.open('rb') as f:
-            start and f.seek(start * size)
-            buffer = f.read((stop - start) * size if stop else None)
-    rows = struct.iter_unpack(fmt, buffer)
-    cols = tuple(zip(*rows))
+        if start == 0 and stop is None:
+            buffer = filename.read_bytes()
+        else:
+            with filename.open('rb') as f:
+                start and f.seek(start * dtype.itemsize)
+                size = (
+                    None if stop is None else (stop - start) * dtype.itemsize
+                )
+                buffer = f.read(size)
+        # Ignore a partially written trailing row.
+        count = len(buffer) // dtype.itemsize
+        table = np.frombuffer(buffer, dtype, count)
+    cols = tuple(table[name] for name in dtype.names)
     return cols
 
 
+def table_dtype(fmt):
+    order, codes = re.fullmatch(r'([@=<>!]?)(.*)', fmt).groups()
+    order = {'': '=', '@': '=', '!': '>'}.get(order, order)
+    fields = []
+    for count, code in re.findall(r'(\d*)([a-zA-Z?])', codes):
+        if code == 's':
+            fields.append(f'V{count or 1}')
+        else:
+            fields += [order + TABLE_TYPES[code]] * int(count or 1)
+    dtype = np.dtype([(f'f{i}', x) for i, x in enumerate(fields)])
+    assert dtype.itemsize == struct.calcsize(fmt), fmt
+    return dtype
+
+
 def table_length(filename, fmt):
     return filename.stat().st_size // struct.calcsize(fmt)
 
 
-def files_write(path, steps, values, encode):
+def table_bisect(filename, fmt, value, lo=0, hi=None):
+    # Binary search over the first column, which needs to be sorted. Reads
+    # only one field per probe so that few bytes are fetched from the file.
+    dtype = table_dtype(fmt)
+    field = dtype[0]
+    hi = table_length(filename, fmt) if hi is None else hi
+    with filename.open('rb') as f:
+        while lo < hi:
+            mid = (lo + hi) // 2
+            f.seek(mid * dtype.itemsize)
+            if np.frombuffer(f.read(field.itemsize), field)[0] < value:
+                lo = mid + 1
+            else:
+                hi = mid
+    return lo
+
+
+def files_write(path, steps, values, encode, packed=False):
     rng = np.random.default_rng(seed=None)
     prefix = int(time.time()).to_bytes(4, 'big')
+    # Keep the layout of existing columns, because readers only use one of
+    # the two index files.
+    if (path / 'shards').exists():
+        packed = True
+    elif (path / 'index').exists():
+        packed = False
+    if packed:
+        # Store the values of one write in a single shard file and index them
+        # by byte range, to avoid creating one object per value.
+        shard = prefix + rng.bytes(4)
+        offsets, lengths = [], []
+        with (path / f'{shard.hex()}.shard').open('wb') as f:
+            for value in values:
+                buffer = encode(value) if encode else value
+                offsets.append(sum(lengths))
+                lengths.append(len(buffer))
+                f.write(buffer)
+        shards = [shard] * len(steps)
+        table_append(path / 'shards', 'q8sqq', steps, shards, offsets, lengths)
+        return
     idents = [prefix + rng.bytes(4) for _ in range(len(steps))]
     for ident, step, value in zip(idents, steps, values):
         filename = f'{step:020}-{ident.hex()}{path.suffix}'
-        buffer = encode(value)
+        buffer = encode(value) if encode else value
         with (path / filename).open('wb') as f:
             f.write(buffer)
     table_append(path / 'index', 'q8s', steps, idents)
 
 
-def files_read(path):
-    steps, idents = table_read(path / 'index', 'q8s')
-    filenames = [
-        path / f'{step:020}-{ident.hex()}{path.suffix}'
-        for step, ident in zip(steps, idents)
-    ]
-    steps = np.int64(steps)
+def files_read(path, start=0, stop=None):
+    filename, fmt = files_index(path)
+    steps, *table = table_read(filename, fmt, start, stop)
+    steps = steps.astype(np.int64)
+    names = files_names(steps, *table)
+    filenames = [path / f'{x}{path.suffix}' for x in names]
     return steps, filenames
 
 
+def files_names(steps, idents, offsets=None, lengths=None):
+    # Values are named after their step and identifier. Values of packed
+    # columns are also named after the byte range in their shard.
+    idents = idents.tolist()
+    names = [f'{s:020}-{x.hex()}' for s, x in zip(steps.tolist(), idents)]
+    if offsets is not None:
+        offsets, lengths = offsets.tolist(), lengths.tolist()
+        names = [f'{x}-{o}-{n}' for x, o, n in zip(names, offsets, lengths)]
+    return names
+
+
+def files_range(name):
+    # Returns the shard file, offset, and length of a value of a packed
+    # column, or None for other values. Names start with the step padded to
+    # 20 characters including its sign.
+    parts = name.split('.', 1)[0][21:].split('-')
+    if len(parts) == 1:
+        return None
+    shard, offset, length = parts
+    return f'{shard}.shard', int(offset), int(length)
+
+
+def files_load(filename):
+    packed = files_range(filename.name)
+    if not packed:
+        return filename.read_bytes()
+    shard, offset, length = packed
+    with (filename.parent / shard).open('rb') as f:
+        f.seek(offset)
+        return f.read(length)
+
+
 def files_length(path):
-    return table_length(path / 'index', 'q8s')
+    return table_length(*files_index(path))
+
+
+def files_bisect(path, step):
+    return table_bisect(*files_index(path), step)
+
+
+def files_index(path):
+    name, fmt = files_table((path / 'shards').exists())
+    return path / name, fmt
+
+
+def files_table(packed):
+    # Returns the name and format of the table that indexes the values.
+    if packed:
+        return 'shards', 'q8sqq'
+    return 'index', 'q8s'
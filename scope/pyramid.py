@@ -0,0 +1,160 @@
+import pathlib
+import sys
+
+import numpy as np
+
+from . import formats
+
+# Each level summarizes blocks of FACTOR rows of the level below it, so level
+# k covers blocks of FACTOR ** (k + 1) rows of the float column. Level rows
+# store first step, last step, count of non-NaN values, min, max, mean, last.
+FACTOR = 16
+FMT = '>qqqdddd'
+FIELDS = ('step', 'last_step', 'count', 'min', 'max', 'mean', 'last')
+
+
+def folder(path):
+    return path.parent / '.pyramid' / path.name
+
+
+def exists(path):
+    return (folder(path) / '0').exists()
+
+
+def create(path):
+    folder(path).mkdir(parents=True, exist_ok=True)
+
+
+def update(path, start, stop):
+    # Appends the blocks completed by the float rows between start and stop.
+    for level in range(64):
+        size = FACTOR ** (level + 1)
+        lo, hi = start // size, stop // size
+        if lo == hi:
+            break
+        filename = folder(path) / str(level)
+        try:
+            length = formats.table_length(filename, FMT)
+        except FileNotFoundError:
+            length = 0
+        if length != lo:
+            return rebuild(path)
+        if level == 0:
+            rows = _raw(*formats.table_read(path, '>qd', lo * size, hi * size))
+        else:
+            below = folder(path) / str(level - 1)
+            rows = formats.table_read(below, FMT, lo * FACTOR, hi * FACTOR)
+        formats.table_append(filename, FMT, *_combine(rows, FACTOR))
+
+
+def rebuild(path, chunk=FACTOR**5):
+    create(path)
+    for filename in folder(path).glob('*'):
+        filename.write_bytes(b'')
+    length = formats.table_length(path, '>qd')
+    for start in range(0, length, chunk):
+        update(path, start, min(start + chunk, length))
+
+
+def read(path, points, start=0, stop=None):
+    # Summarizes the rows between start and stop into the requested number
+    # of blocks. Reads from the coarsest level that still has at least that
+    # many blocks, fills the unaligned edges from finer levels, and merges
+    # the result down to the requested number of blocks.
+    if stop is None:
+        stop = formats.table_length(path, '>qd')
+    lengths = []
+    while True:
+        filename = folder(path) / str(len(lengths))
+        if not filename.exists():
+            break
+        lengths.append(formats.table_length(filename, FMT))
+    level = -1
+    while level + 1 < len(lengths):
+        if (stop - start) // FACTOR ** (level + 2) < points:
+            break
+        level += 1
+    parts = _cover(path, lengths, start, stop, level)
+    parts = [x for x in parts if len(x[0])]
+    if not parts:
+        return {k: np.zeros(0, np.float64) for k in FIELDS}
+    return _merge([np.concatenate(x) for x in zip(*parts)], points)
+
+
+def summarize(steps, values, points):
+    # Fallback for columns without pyramid that reads all rows.
+    return _merge(_raw(steps, values), points)
+
+
+def _cover(path, lengths, start, stop, level):
+    if start >= stop:
+        return []
+    if level < 0:
+        return [_raw(*formats.table_read(path, '>qd', start, stop))]
+    size = FACTOR ** (level + 1)
+    lo = -(-start // size)
+    hi = min(stop // size, lengths[level])
+    if lo >= hi:
+        return _cover(path, lengths, start, stop, level - 1)
+    filename = folder(path) / str(level)
+    return [
+        *_cover(path, lengths, start, lo * size, level - 1),
+        formats.table_read(filename, FMT, lo, hi),
+        *_cover(path, lengths, hi * size, stop, level - 1),
+    ]
+
+
+def _raw(steps, values):
+    steps = steps.astype(np.int64)
+    values = values.astype(np.float64)
+    count = (~np.isnan(values)).astype(np.int64)
+    return steps, steps, count, values, values, values, values
+
+
+def _merge(rows, points):
+    # Merges consecutive rows into the given number of groups whose sizes
+    # differ by at most one row.
+    step, last_step, count, low, high, mean, last = rows
+    if len(step) > points:
+        starts = np.linspace(0, len(step), points + 1).astype(np.int64)[:-1]
+        ends = np.append(starts[1:], len(step)) - 1
+        weighted = np.where(count > 0, mean * count, 0.0)
+        total = np.add.reduceat(count, starts)
+        weighted = np.add.reduceat(weighted, starts)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(total > 0, weighted / total, np.nan)
+        step, last_step, count = step[starts], last_step[ends], total
+        low = np.fmin.reduceat(low, starts)
+        high = np.fmax.reduceat(high, starts)
+        last = last[ends]
+    return dict(zip(FIELDS, (step, last_step, count, low, high, mean, last)))
+
+
+def _combine(rows, size):
+    step, last_step, count, low, high, mean, last = [
+        np.asarray(x).reshape(-1, size) for x in rows
+    ]
+    total = count.sum(1)
+    weighted = np.where(count > 0, mean * count, 0.0).sum(1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(total > 0, weighted / total, np.nan)
+    return (
+        step[:, 0],
+        last_step[:, -1],
+        total,
+        np.fmin.reduce(low, 1),
+        np.fmax.reduce(high, 1),
+        mean,
+        last[:, -1],
+    )
+
+
+def main(logdirs):
+    for logdir in logdirs:
+        for path in sorted(pathlib.Path(logdir, 'scope').glob('*.float')):
+            print(f'Rebuilding pyramid for {path}')
+            rebuild(path)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
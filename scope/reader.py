@@ -1,30 +1,35 @@
-import re
+import collections
+import concurrent.futures
 import pathlib
+import re
+import time
 
-from . import formats
+import numpy as np
 
+from . import formats
 
 FORMATS = [
     formats.Text(),
     formats.Float(),
+    formats.CompressedFloat(),
     formats.Image(),
     formats.Video(),
 ]
 
 
 class Reader:
-    def __init__(self, logdir, formats=None):
+    def __init__(self, logdir, formats=None, mmap=False):
         formats = formats or FORMATS
+        if mmap:
+            # Memory-mapped columns are read-only views into local files.
+            formats = [_mmap(x) for x in formats]
         if isinstance(logdir, str):
             logdir = pathlib.Path(logdir)
         self.logdir = logdir / 'scope'
         self.fmts = {x.extension: x for x in formats}
         self.cols = {}
-        for child in sorted(self.logdir.glob('*')):
-            basename, ext = child.name.rsplit('.', 1)
-            key = basename.replace('-', '/')
-            assert re.match(r'[a-z0-9_]+(/[a-z0-9_]+)?', key), key
-            self.cols[key] = (child.name, self.fmts[ext])
+        self.offsets = {}
+        self._scan()
 
     def keys(self):
         return tuple(self.cols.keys())
@@ -33,12 +38,131 @@ class Reader:
         name, fmt = self.cols[key]
         return fmt.read(self.logdir / name)
 
+    def read(self, key, start=None, stop=None):
+        name, fmt = self.cols[key]
+        path = self.logdir / name
+        if (start or 0) < 0 or (stop or 0) < 0:
+            start, stop, _ = slice(start, stop).indices(fmt.length(path))
+        start = start or 0
+        if stop is not None and stop < start:
+            stop = start
+        return fmt.read(path, start, stop)
+
+    def read_steps(self, key, lo=None, hi=None):
+        # Returns the rows with lo <= step < hi and assumes sorted steps.
+        name, fmt = self.cols[key]
+        path = self.logdir / name
+        start = 0 if lo is None else fmt.bisect(path, lo)
+        stop = None if hi is None else max(start, fmt.bisect(path, hi))
+        return fmt.read(path, start, stop)
+
+    def summary(self, key, points=1000, lo=None, hi=None):
+        # Summarizes the rows with lo <= step < hi into about the requested
+        # number of blocks, using the pyramid levels of the column if any.
+        name, fmt = self.cols[key]
+        path = self.logdir / name
+        start = 0 if lo is None else fmt.bisect(path, lo)
+        stop = None if hi is None else max(start, fmt.bisect(path, hi))
+        return fmt.summary(path, points, start, stop)
+
     def length(self, key):
         name, fmt = self.cols[key]
         return fmt.length(self.logdir / name)
 
     def load(self, key, filename):
         _, fmt = self.cols[key]
-        buffer = (self.logdir / filename).read_bytes()
+        buffer = formats.files_load(self.logdir / filename)
         value = fmt.decode(buffer)
         return value
+
+    def load_many(
+        self, key, filenames, workers=16, prefetch=None, stack=False
+    ):
+        # Loads and decodes the files concurrently and yields the values in
+        # order. At most prefetch values are loaded ahead of the consumer, so
+        # memory stays bounded. With stack, returns a single array instead,
+        # which requires all values to have the same shape.
+        filenames = list(filenames)
+        values = _imap(
+            lambda x: self.load(key, x), filenames, workers, prefetch
+        )
+        if not stack:
+            return values
+        array = None
+        for index, value in enumerate(values):
+            value = np.asarray(value)
+            if array is None:
+                shape = (len(filenames), *value.shape)
+                array = np.empty(shape, value.dtype)
+            if value.shape != array.shape[1:]:
+                values.close()
+                raise ValueError(
+                    f"Value {filenames[index]} of key '{key}' has shape "
+                    f'{value.shape} instead of {array.shape[1:]}'
+                )
+            array[index] = value
+        return np.zeros((0,)) if array is None else array
+
+    def read_many(self, keys, workers=16, prefetch=None):
+        # Reads the columns concurrently and yields their steps and values in
+        # the order of the keys.
+        return _imap(self.__getitem__, keys, workers, prefetch)
+
+    def poll(self):
+        # Returns the rows appended since the previous call, including the
+        # rows of keys that were created since then.
+        self._scan()
+        results = {}
+        for key, (name, fmt) in self.cols.items():
+            start = self.offsets.get(key, 0)
+            try:
+                stop = fmt.length(self.logdir / name)
+            except FileNotFoundError:
+                continue  # Column is still being created.
+            if stop > start:
+                results[key] = fmt.read(self.logdir / name, start, stop)
+                self.offsets[key] = stop
+        return results
+
+    def follow(self, interval=30):
+        while True:
+            results = self.poll()
+            if results:
+                yield results
+            time.sleep(interval)
+
+    def _scan(self):
+        cols = {}
+        for child in sorted(self.logdir.glob('*')):
+            if child.name.startswith('.'):
+                continue
+            basename, ext = child.name.rsplit('.', 1)
+            key = basename.replace('-', '/')
+            assert re.match(r'[a-z0-9_]+(/[a-z0-9_]+)?', key), key
+            cols[key] = (child.name, self.fmts[ext])
+        self.cols = cols
+
+
+def _imap(fn, items, workers, prefetch=None):
+    if not workers:
+        yield from map(fn, items)
+        return
+    prefetch = prefetch or 2 * workers
+    pool = concurrent.futures.ThreadPoolExecutor(workers, 'scope_reader')
+    futures = collections.deque()
+    try:
+        for item in items:
+            futures.append(pool.submit(fn, item))
+            if len(futures) >= prefetch:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+    finally:
+        # Stops loading ahead when the consumer breaks out of the loop.
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _mmap(fmt):
+    if isinstance(fmt, formats.Float):
+        return formats.Float(mmap=True)
+    return fmt
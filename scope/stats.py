@@ -0,0 +1,82 @@
+import bisect
+import collections
+import threading
+
+# Upper bounds of histogram buckets, from one microsecond to about an hour
+# for durations in seconds, and from one to about a billion for sizes.
+SECONDS = tuple(1e-6 * 2**i for i in range(32))
+SIZES = tuple(2**i for i in range(31))
+
+
+class Histogram:
+    def __init__(self, bounds=SECONDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def summary(self):
+        buckets = {
+            bound: count
+            for bound, count in zip((*self.bounds, float('inf')), self.counts)
+            if count
+        }
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0,
+            'max': self.max,
+            'buckets': buckets,
+        }
+
+
+class Stats:
+    # Thread-safe counters and histograms, keyed by a group such as None for
+    # the writer itself or the name of a column or format.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(dict)
+        self.hists = collections.defaultdict(dict)
+
+    def inc(self, name, amount=1, group=None):
+        with self.lock:
+            counters = self.counters[group]
+            counters[name] = counters.get(name, 0) + amount
+
+    def observe(self, name, value, group=None, bounds=SECONDS):
+        with self.lock:
+            hists = self.hists[group]
+            if name not in hists:
+                hists[name] = Histogram(bounds)
+            hists[name].observe(value)
+
+    def total(self, name):
+        # Sum of a counter or histogram over all groups.
+        with self.lock:
+            total = sum(x.get(name, 0) for x in self.counters.values())
+            for hists in self.hists.values():
+                if name in hists:
+                    total += hists[name].total
+            return total
+
+    def summary(self, group=None):
+        with self.lock:
+            return {
+                **self.counters.get(group, {}),
+                **{
+                    k: v.summary()
+                    for k, v in self.hists.get(group, {}).items()
+                },
+            }
+
+    def groups(self):
+        with self.lock:
+            return [x for x in {*self.counters, *self.hists} if x is not None]
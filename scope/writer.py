@@ -1,12 +1,19 @@
+import atexit
 import concurrent.futures
 import dataclasses
+import inspect
+import itertools
+import multiprocessing
 import pathlib
 import re
+import threading
+import time
+import weakref
+from multiprocessing import shared_memory
 
 import numpy as np
 
-from . import formats
-
+from . import formats, stats
 
 FORMATS = [
     formats.Text(),
@@ -15,6 +22,19 @@ FORMATS = [
     formats.Video(fps=10),
 ]
 
+# Keys under this prefix are reserved for the writer's own telemetry.
+STATS_PREFIX = 'scope/'
+
+# Writers that are still open at exit. The set holds weak references, so that
+# writers that go out of scope without being closed can be garbage collected.
+WRITERS = weakref.WeakSet()
+
+
+@atexit.register
+def _close_writers():
+    for writer in list(WRITERS):
+        writer.close()
+
 
 @dataclasses.dataclass
 class Column:
@@ -23,10 +43,36 @@ class Column:
     created: bool
     steps: list
     values: list
+    encoded: list = dataclasses.field(default_factory=list)
+    queue: list = dataclasses.field(default_factory=list)
+    busy: bool = False
+
+
+@dataclasses.dataclass
+class Job:
+    steps: list
+    values: list
+    encoded: bool
+    nbytes: int
+    batch: int
 
 
 class Writer:
-    def __init__(self, logdir, workers=8, formats=None):
+    def __init__(
+        self,
+        logdir,
+        workers=8,
+        formats=None,
+        encoder='thread',
+        processes=4,
+        queue=4,
+        queue_bytes=None,
+        policy='block',
+        stats_every=None,
+        stats_callback=None,
+    ):
+        assert encoder in ('thread', 'process'), encoder
+        assert policy in ('block', 'drop', 'coalesce'), policy
         formats = formats or FORMATS
         if isinstance(logdir, str):
             logdir = pathlib.Path(logdir)
@@ -36,17 +82,188 @@ class Writer:
         self.rng = np.random.default_rng(seed=None)
         self.fmts = formats
         self.cols = {}
+        self.streams = {}
+        # Flushes are written in the background. Queued writes of the same
+        # column are merged and each column has at most one write in flight,
+        # so that rows are appended in order. When queue flushes are still
+        # unfinished or queue_bytes would be exceeded, the policy decides
+        # whether flush blocks, drops the oldest queued media, or merges the
+        # float rows into the newest unfinished flush.
+        self.queue = queue
+        self.queue_bytes = queue_bytes
+        self.policy = policy
+        self.cond = threading.Condition()
+        self.batches = {}
+        self.nbatches = 0
+        self.nbytes = 0
+        self.error = None
+        self.closed = False
         if workers:
             self.pool = concurrent.futures.ThreadPoolExecutor(workers, 'scope')
-            self.futures = []
+        self.procs = None
+        if encoder == 'process':
+            # Encode media in separate processes so that compression does not
+            # compete with the training loop for the GIL.
+            context = multiprocessing.get_context('spawn')
+            self.procs = concurrent.futures.ProcessPoolExecutor(
+                processes, context
+            )
+        # Timings and sizes for stats(). Every stats_every seconds, a flush
+        # passes them to the callback or, without callback, logs their totals
+        # as float columns under the reserved key prefix.
+        self.metrics = stats.Stats()
+        self.stats_every = stats_every
+        self.stats_callback = stats_callback
+        self.stats_time = time.perf_counter()
+        self.step = None
+        WRITERS.add(self)
 
     def add(self, step, *args, **kwargs):
+        start = time.perf_counter()
         assert isinstance(step, (int, np.integer)), type(step)
         step = int(step)
         mapping = dict(*args, **kwargs)
+        self._add(step, mapping)
+        self.metrics.observe('add', time.perf_counter() - start)
+        self.metrics.inc('values', len(mapping))
+
+    def add_frames(self, step, key, frames):
+        # Encodes the frames of a video incrementally, so that long videos do
+        # not need to be kept in memory. The video is written on end_video(),
+        # or on close() at the step of its last frames. Frames are encoded on
+        # the calling thread, not on the encoder pool.
+        assert isinstance(step, (int, np.integer)), type(step)
+        if key not in self.cols:
+            assert re.match(r'[a-z0-9_]+(/[a-z0-9_]+)?', key), key
+            for fmt in self.fmts:
+                if hasattr(fmt, 'stream') and fmt.valid(frames):
+                    break
+            else:
+                raise NotImplementedError(
+                    f"No format supports streaming '{key}' with "
+                    f'{self._info(frames)}'
+                )
+            name = key.replace('/', '-') + '.' + fmt.extension
+            self.cols[key] = Column(fmt, name, False, [], [])
+        col = self.cols[key]
+        if not hasattr(col.fmt, 'stream') or not col.fmt.valid(frames):
+            raise ValueError(
+                f"Key '{key}' contains invalid frames {self._info(frames)}"
+            )
+        if key not in self.streams:
+            self.streams[key] = [None, col.fmt.stream()]
+        self.streams[key][0] = int(step)
+        self.streams[key][1].add(frames)
+
+    def end_video(self, step, key):
+        assert isinstance(step, (int, np.integer)), type(step)
+        _, stream = self.streams.pop(key)
+        buffer = stream.close()
+        col = self.cols[key]
+        col.steps.append(int(step))
+        col.values.append(buffer)
+        col.encoded.append(True)
+
+    def flush(self):
+        start = time.perf_counter()
+        if self.workers:
+            with self.cond:
+                self._raise()
+        if self.stats_every and start - self.stats_time >= self.stats_every:
+            self.stats_time = start
+            self._log_stats()
+        jobs = []
+        for col in self.cols.values():
+            # Rows of streamed videos are already encoded. Consecutive rows of
+            # the same kind are written together, in the order they were added.
+            rows = zip(col.steps, col.values, col.encoded)
+            for encoded, group in itertools.groupby(rows, lambda x: x[2]):
+                steps, values, _ = map(list, zip(*group))
+                jobs.append((col, steps, values, encoded))
+            col.steps = []
+            col.values = []
+            col.encoded = []
+        if not self.workers:
+            for job in jobs:
+                self._write(*job)
+        elif jobs:
+            with self.cond:
+                self._enqueue(jobs)
+        self.metrics.observe('flush', time.perf_counter() - start)
+
+    def stats(self):
+        # Counters and histograms of the time spent in add(), flush() and
+        # waiting for the queue, and of the encode and write times and bytes
+        # written per column and per format. Values that are not encoded in
+        # the encoder processes are encoded during the write and count with
+        # their size before encoding.
+        result = self.metrics.summary()
+        with self.cond:
+            result['queue'] = {
+                'batches': len(self.batches),
+                'bytes': self.nbytes,
+            }
+        groups = self.metrics.groups()
+        for kind in ('column', 'format'):
+            result[kind + 's'] = {
+                name: self.metrics.summary((kind, name))
+                for kind_, name in sorted(groups)
+                if kind_ == kind
+            }
+        return result
+
+    def wait(self):
+        if not self.workers:
+            return
+        with self.cond:
+            while self.batches:
+                self.cond.wait()
+            self._raise()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        WRITERS.discard(self)
+        with self.cond:
+            error, self.error = self.error, None
+        for key, (step, _) in list(self.streams.items()):
+            print(f"Ending video '{key}' that is still open on close")
+            self.end_video(step, key)
+        self.flush()
+        if self.workers:
+            with self.cond:
+                while any(col.busy for col in self.cols.values()):
+                    self.cond.wait()
+            self.pool.shutdown()
+        if self.procs:
+            self.procs.shutdown()
+            self.procs = None
+        # Write what is still queued in this thread, because the pools do not
+        # accept new work during interpreter shutdown.
+        for col in self.cols.values():
+            jobs, col.queue = col.queue, []
+            if jobs:
+                self._run(col, jobs)
+        with self.cond:
+            error, self.error = error or self.error, None
+        if error:
+            raise error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _add(self, step, mapping, internal=False):
         for key, value in mapping.items():
             if key not in self.cols:
                 assert re.match(r'[a-z0-9_]+(/[a-z0-9_]+)?', key), key
+                if key.startswith(STATS_PREFIX) and not internal:
+                    raise ValueError(
+                        f"Key prefix '{STATS_PREFIX}' is reserved"
+                    )
                 for fmt in self.fmts:
                     if fmt.valid(value):
                         break
@@ -64,34 +281,221 @@ class Writer:
             value = col.fmt.convert(value)
             col.steps.append(step)
             col.values.append(value)
+            col.encoded.append(False)
+        self.step = step if self.step is None else max(self.step, step)
 
-    def flush(self):
-        if self.workers:
-            list(self.futures)
-            jobs = [
-                (c, c.steps, c.values) for c in self.cols.values() if c.steps
-            ]
-            self.futures = self.pool.map(self._write, *zip(*jobs))
-        else:
-            for col in self.cols.values():
-                if col.steps:
-                    self._write(col, col.steps, col.values)
-        for col in self.cols.values():
-            col.steps = []
-            col.values = []
+    def _enqueue(self, jobs):
+        if self.policy == 'coalesce' and self._full() and self.batches:
+            batch = max(self.batches)
+            for job in jobs:
+                if not self._media(job[0]):
+                    self._push(*job, batch)
+            jobs = [x for x in jobs if self._media(x[0])]
+            if not jobs:
+                return
+        nbytes = sum(_nbytes(job[2]) for job in jobs)
+        start = time.perf_counter()
+        while self._full(nbytes):
+            if self.policy == 'drop' and self._drop():
+                continue
+            self.cond.wait()
+            self._raise()
+        self.metrics.observe('flush_wait', time.perf_counter() - start)
+        batch = self.nbatches
+        self.nbatches += 1
+        for job in jobs:
+            self._push(*job, batch)
+        self.metrics.observe(
+            'queue_batches', len(self.batches), None, stats.SIZES
+        )
+        self.metrics.observe('queue_bytes', self.nbytes, None, stats.SIZES)
+
+    def _push(self, col, steps, values, encoded, batch):
+        job = Job(steps, values, encoded, _nbytes(values), batch)
+        self.batches[batch] = self.batches.get(batch, 0) + 1
+        self.nbytes += job.nbytes
+        col.queue.append(job)
+        self._dispatch(col)
+
+    def _dispatch(self, col):
+        if col.busy or not col.queue:
+            return
+        jobs, col.queue = col.queue, []
+        col.busy = True
+        try:
+            self.pool.submit(self._run, col, jobs)
+        except RuntimeError:  # Pool is shutting down.
+            col.queue = jobs + col.queue
+            col.busy = False
+
+    def _run(self, col, jobs):
+        try:
+            for encoded, group in itertools.groupby(jobs, lambda x: x.encoded):
+                group = list(group)
+                steps = [x for job in group for x in job.steps]
+                values = [x for job in group for x in job.values]
+                self._write(col, steps, values, encoded)
+        except Exception as e:  # noqa: BLE001
+            with self.cond:
+                self.error = self.error or e
+        finally:
+            with self.cond:
+                for job in jobs:
+                    self._done(job)
+                col.busy = False
+                self._dispatch(col)
+                self.cond.notify_all()
+
+    def _done(self, job):
+        self.nbytes -= job.nbytes
+        self.batches[job.batch] -= 1
+        if not self.batches[job.batch]:
+            del self.batches[job.batch]
+
+    def _drop(self):
+        queued = [
+            (job.batch, col, job)
+            for col in self.cols.values()
+            if self._media(col)
+            for job in col.queue
+        ]
+        if not queued:
+            return False
+        _, col, job = min(queued, key=lambda x: x[0])
+        print(f"Dropping {len(job.steps)} queued values of '{col.name}'")
+        col.queue.remove(job)
+        self._done(job)
+        self.metrics.inc('dropped', len(job.steps))
+        self.metrics.inc('dropped', len(job.steps), ('column', col.name))
+        return True
 
-    def _write(self, col, steps, values):
+    def _full(self, nbytes=0):
+        if self.queue and len(self.batches) >= self.queue:
+            return True
+        if self.queue_bytes and self.nbytes + nbytes > self.queue_bytes:
+            return bool(self.batches)
+        return False
+
+    def _media(self, col):
+        return hasattr(col.fmt, 'encode')
+
+    def _raise(self):
+        if self.error:
+            error, self.error = self.error, None
+            raise error
+
+    def _write(self, col, steps, values, encoded=False):
         try:
             path = self.logdir / col.name
             if not col.created:
                 col.fmt.create(path)
                 col.created = True
-            col.fmt.write(path, steps, values)
+            buffers = values if encoded else None
+            # Only arrays are worth sending to the encoder processes. Other
+            # values such as strings are cheap to encode in this thread.
+            # Otherwise, formats encode the values in their write(), which
+            # custom formats may define without the encoded argument.
+            arrays = all(isinstance(x, np.ndarray) for x in values)
+            if (
+                buffers is None
+                and self.procs
+                and self._media(col)
+                and arrays
+                and _accepts_encoded(col.fmt)
+            ):
+                start = time.perf_counter()
+                try:
+                    buffers = self._encode(col.fmt, values)
+                    self._observe(col, 'encode', time.perf_counter() - start)
+                except RuntimeError:  # Process pool is shutting down.
+                    pass
+            start = time.perf_counter()
+            if buffers is None:
+                col.fmt.write(path, steps, values)
+                nbytes = _nbytes(values) + 8 * len(steps)
+            else:
+                col.fmt.write(path, steps, buffers, encoded=True)
+                nbytes = _nbytes(buffers)
+            self._observe(col, 'write', time.perf_counter() - start)
+            self._observe(col, 'rows', len(steps), counter=True)
+            self._observe(col, 'bytes', nbytes, counter=True)
         except Exception:
             print(f"Exception writing '{col.name}' column")
             raise
 
+    def _observe(self, col, name, value, counter=False):
+        # Records for the writer as a whole, the column, and its format.
+        fmt = type(col.fmt).__name__
+        for group in (None, ('column', col.name), ('format', fmt)):
+            if counter:
+                self.metrics.inc(name, value, group)
+            else:
+                self.metrics.observe(name, value, group)
+
+    def _log_stats(self):
+        result = self.stats()
+        if self.stats_callback:
+            self.stats_callback(result)
+            return
+        if self.step is None:
+            return
+        values = {
+            f'{name}_seconds': result[name]['total']
+            for name in ('add', 'flush', 'flush_wait', 'encode', 'write')
+            if name in result
+        }
+        values['write_bytes'] = result.get('bytes', 0)
+        values['queue_batches'] = result['queue']['batches']
+        values['queue_bytes'] = result['queue']['bytes']
+        values = {STATS_PREFIX + k: v for k, v in values.items()}
+        self._add(self.step, values, internal=True)
+
+    def _encode(self, fmt, values):
+        # Arrays are passed to the encoder processes via shared memory to
+        # avoid pickling them.
+        futures, shms = [], []
+        try:
+            for value in values:
+                size = max(1, value.nbytes)
+                shm = shared_memory.SharedMemory(create=True, size=size)
+                shms.append(shm)
+                np.ndarray(value.shape, value.dtype, shm.buf)[...] = value
+                args = (fmt, shm.name, value.shape, value.dtype.str)
+                futures.append(self.procs.submit(_encode_shared, *args))
+            return [future.result() for future in futures]
+        finally:
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+
     def _info(self, value):
         if hasattr(value, 'dtype') and hasattr(value, 'shape'):
             return f"dtype '{value.dtype}' and shape '{value.shape}'"
         return f"type '{type(value)}'"
+
+
+def _accepts_encoded(fmt):
+    return 'encoded' in inspect.signature(fmt.write).parameters
+
+
+def _nbytes(values):
+    total = 0
+    for value in values:
+        if hasattr(value, 'nbytes'):
+            total += value.nbytes
+        elif isinstance(value, (str, bytes)):
+            total += len(value)
+        else:
+            total += 8
+    return total
+
+
+def _encode_shared(fmt, name, shape, dtype):
+    shm = shared_memory.SharedMemory(name)
+    try:
+        value = np.ndarray(shape, dtype, shm.buf)
+        buffer = fmt.encode(value)
+        del value
+        return buffer
+    finally:
+        shm.close()
@@ -0,0 +1,56 @@
+import re
+import warnings
+
+import numpy as np
+
+STATS = ('mean', 'std', 'min', 'max', 'median', 'count')
+
+
+def parse_stats(stats):
+    stats = stats.split(',')
+    for stat in stats:
+        if stat not in STATS and not re.fullmatch(r'p(100|[1-9]?[0-9])', stat):
+            raise ValueError(f'Unknown statistic {stat!r}')
+    return stats
+
+
+def aggregate(cols, stats, grid, lo=None, hi=None):
+    # Interpolates each column onto a common grid of steps and computes the
+    # statistics across columns. Grid points outside of the steps of a column
+    # count as missing for that column.
+    cols = [(s, v) for s, v in cols if len(s)]
+    if not cols:
+        return np.zeros(0), {x: np.zeros(0) for x in stats}
+    lo = min(s.min() for s, _ in cols) if lo is None else lo
+    hi = max(s.max() for s, _ in cols) if hi is None else hi
+    steps = np.linspace(lo, hi, grid)
+    table = np.stack([interpolate(s, v, steps) for s, v in cols])
+    return steps, {x: statistic(table, x) for x in stats}
+
+
+def interpolate(steps, values, grid):
+    # Steps can be out of order after restoring checkpoints.
+    order = np.argsort(steps, kind='stable')
+    steps, values = steps[order].astype(np.float64), values[order]
+    result = np.interp(grid, steps, values)
+    result[(grid < steps[0]) | (grid > steps[-1])] = np.nan
+    return result
+
+
+def statistic(table, stat):
+    # Grid points where all columns are missing result in NaN.
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        if stat == 'count':
+            return (~np.isnan(table)).sum(0)
+        if stat == 'mean':
+            return np.nanmean(table, 0)
+        if stat == 'std':
+            return np.nanstd(table, 0)
+        if stat == 'min':
+            return np.nanmin(table, 0)
+        if stat == 'max':
+            return np.nanmax(table, 0)
+        if stat == 'median':
+            return np.nanmedian(table, 0)
+        return np.nanpercentile(table, int(stat[1:]), 0)
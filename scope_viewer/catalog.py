@@ -0,0 +1,255 @@
+import asyncio
+import fcntl
+import sqlite3
+import time
+
+import numpy as np
+
+import scope
+
+import filesystems
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+  id TEXT PRIMARY KEY, exp TEXT, ncols INTEGER, last_step INTEGER,
+  modified REAL, crawled REAL);
+CREATE TABLE IF NOT EXISTS cols (
+  id TEXT PRIMARY KEY, run TEXT, key TEXT, ext TEXT, size INTEGER,
+  length INTEGER, last_step INTEGER, modified REAL);
+CREATE INDEX IF NOT EXISTS runs_exp ON runs (exp);
+CREATE INDEX IF NOT EXISTS runs_last_step ON runs (last_step);
+CREATE INDEX IF NOT EXISTS runs_modified ON runs (modified);
+CREATE INDEX IF NOT EXISTS cols_run ON cols (run);
+CREATE INDEX IF NOT EXISTS cols_key ON cols (key);
+"""
+
+RUN_SORTS = ('id', 'exp', 'ncols', 'last_step', 'modified')
+COL_SORTS = ('id', 'key', 'ext', 'length', 'last_step', 'modified')
+
+
+class Catalog:
+    # SQLite index of all runs and their columns for searching without
+    # touching storage. One server worker crawls the storage in the background
+    # and updates columns whose files changed size since the last crawl. Sizes
+    # come from listings, so that a crawl needs one storage call per run and
+    # per column folder. The other workers only query the index.
+
+    def __init__(self, fs, basedir, filename, find_runs, interval=300):
+        self.fs = fs
+        self.basedir = basedir
+        self.filename = filename
+        self.find_runs = find_runs
+        self.interval = interval
+        # The connection is created on import but used from the event loop.
+        self.db = sqlite3.connect(
+            filename, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.executescript(SCHEMA)
+        self.lockfile = None
+
+    def start(self):
+        # Only the worker that holds the lock crawls.
+        lockfile = open(f'{self.filename}.lock', 'a')  # noqa: SIM115
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lockfile.close()
+            return None
+        self.lockfile = lockfile
+        return asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while True:
+            try:
+                await self.crawl()
+            except Exception as e:  # noqa: BLE001
+                print(f'Error crawling catalog: {e!r}', flush=True)
+            await asyncio.sleep(self.interval)
+
+    async def crawl(self):
+        start = time.time()
+        print('Crawling catalog', flush=True)
+        for expdir in await self.fs.alist(self.basedir):
+            rundirs = await self.find_runs(expdir)
+            await asyncio.gather(*[self.update_run(x) for x in rundirs])
+        self.db.execute('BEGIN')
+        self.db.execute(
+            'DELETE FROM cols WHERE run IN '
+            '(SELECT id FROM runs WHERE crawled < ?)',
+            (start,),
+        )
+        self.db.execute('DELETE FROM runs WHERE crawled < ?', (start,))
+        self.db.execute('COMMIT')
+        nruns = self.db.execute('SELECT COUNT(*) FROM runs').fetchone()[0]
+        duration = time.time() - start
+        print(f'Crawled {nruns} runs in {duration:.1f}s', flush=True)
+
+    async def update_run(self, rundir):
+        runid = self._id(rundir)
+        children = await self.fs.alist_sizes(rundir + '/scope')
+        children = [x for x in children if x[0].rsplit('/', 1)[-1][0] != '.']
+        known = {
+            colid: (size, length, last_step, modified)
+            for colid, size, length, last_step, modified in self.db.execute(
+                'SELECT id, size, length, last_step, modified FROM cols '
+                'WHERE run = ?',
+                (runid,),
+            )
+        }
+        rows = await asyncio.gather(
+            *[self._col(x, size, known) for x, size in children]
+        )
+        rows = [x for x in rows if x]
+        now = time.time()
+        steps = [x[6] for x in rows if x[6] is not None]
+        self.db.execute('BEGIN')
+        self.db.execute('DELETE FROM cols WHERE run = ?', (runid,))
+        self.db.executemany(
+            'INSERT INTO cols VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows
+        )
+        self.db.execute(
+            'INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?)',
+            (
+                runid,
+                runid.split(':', 1)[0],
+                len(rows),
+                max(steps) if steps else None,
+                max([x[7] for x in rows], default=None),
+                now,
+            ),
+        )
+        self.db.execute('COMMIT')
+
+    def runs(
+        self,
+        pattern=None,
+        exp=None,
+        key=None,
+        min_step=None,
+        since=None,
+        sort='id',
+        desc=False,
+        limit=100,
+        offset=0,
+    ):
+        assert sort in RUN_SORTS, sort
+        conds, args = [], []
+        if pattern:
+            conds.append(_match('id', pattern, args))
+        if exp:
+            conds.append('exp = ?')
+            args.append(exp)
+        if key:
+            conds.append('id IN (SELECT run FROM cols WHERE key = ?)')
+            args.append(key)
+        if min_step is not None:
+            conds.append('last_step >= ?')
+            args.append(min_step)
+        if since is not None:
+            conds.append('modified >= ?')
+            args.append(since)
+        fields = ('id', 'exp', 'ncols', 'last_step', 'modified')
+        return self._query(
+            'runs', fields, conds, args, sort, desc, limit, offset
+        )
+
+    def cols(
+        self,
+        run=None,
+        pattern=None,
+        key=None,
+        ext=None,
+        sort='id',
+        desc=False,
+        limit=1000,
+        offset=0,
+    ):
+        assert sort in COL_SORTS, sort
+        conds, args = [], []
+        if run:
+            conds.append('run = ?')
+            args.append(run)
+        if pattern:
+            conds.append(_match('id', pattern, args))
+        if key:
+            conds.append('key = ?')
+            args.append(key)
+        if ext:
+            conds.append('ext = ?')
+            args.append(ext)
+        fields = ('id', 'run', 'key', 'ext', 'length', 'last_step', 'modified')
+        return self._query(
+            'cols', fields, conds, args, sort, desc, limit, offset
+        )
+
+    def _query(self, table, fields, conds, args, sort, desc, limit, offset):
+        where = f'WHERE {" AND ".join(conds)}' if conds else ''
+        order = f'ORDER BY {sort} {"DESC" if desc else "ASC"}, id'
+        (total,) = self.db.execute(
+            f'SELECT COUNT(*) FROM {table} {where}', args
+        ).fetchone()
+        rows = self.db.execute(
+            f'SELECT {", ".join(fields)} FROM {table} {where} {order} '
+            'LIMIT ? OFFSET ?',
+            [*args, limit, offset],
+        ).fetchall()
+        return [dict(zip(fields, row)) for row in rows], total
+
+    async def _col(self, path, size, known):
+        # The size is from the listing of the run and None for folders.
+        colid = self._id(path)
+        name = path.rsplit('/', 1)[-1]
+        if '.' not in name:
+            return None
+        key, ext = name.rsplit('.', 1)
+        key = key.replace('-', '/')
+        runid = colid.rsplit(':', 2)[0]
+        try:
+            if ext == 'float':
+                table, dtype = path, np.dtype('>i8,>f8')
+            elif ext == 'cfloat':
+                size = sum(await self.fs.asizes(path, ('index', 'tail')))
+            else:
+                sizes = await self.fs.asizes(path, ('shards', 'index'))
+                name, fmt = scope.formats.files_table(bool(sizes[0]))
+                table, dtype = f'{path}/{name}', scope.formats.table_dtype(fmt)
+                size = sizes[0] or sizes[1]
+        except Exception as e:  # noqa: BLE001
+            print(f'Error crawling {path}: {e!r}', flush=True)
+            return None
+        if colid in known and known[colid][0] == size:
+            return (colid, runid, key, ext, size, *known[colid][1:])
+        if ext == 'cfloat':
+            column = filesystems.FsPath(self.fs, path)
+            length, last_step = await asyncio.to_thread(_compressed, column)
+        else:
+            length = size // dtype.itemsize
+            last_step = None
+            if length:
+                start = (length - 1) * dtype.itemsize
+                async with await self.fs.aopen(table, start, size) as f:
+                    row = await f.read(dtype.itemsize)
+                last_step = int(np.frombuffer(row, dtype)['f0'][0])
+        return (colid, runid, key, ext, size, length, last_step, time.time())
+
+    def _id(self, path):
+        return path.removeprefix(self.basedir)[1:].replace('/', ':')
+
+
+def _match(field, pattern, args):
+    # Patterns with wildcards use glob syntax, others match substrings.
+    if any(x in pattern for x in '*?['):
+        args.append(pattern)
+        return f'{field} GLOB ?'
+    args.append(f'%{pattern}%')
+    return f'{field} LIKE ?'
+
+
+def _compressed(column):
+    fmt = scope.formats.CompressedFloat()
+    length = fmt.length(column)
+    if not length:
+        return 0, None
+    steps, _ = fmt.read(column, length - 1, length)
+    return length, int(steps[0])
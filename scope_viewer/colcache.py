@@ -0,0 +1,86 @@
+import collections
+import threading
+
+import numpy as np
+
+import metrics
+
+
+class ColumnCache:
+    # Keeps parsed tables of recently requested columns in memory. Columns are
+    # append-only, so a hit only compares the file size and reads the new rows
+    # from the end of the file.
+
+    def __init__(self, fs, maxbytes):
+        self.fs = fs
+        self.maxbytes = maxbytes
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    async def aread(self, path, dtype):
+        dtype = np.dtype(dtype)
+        size = await self.fs.asize(path)
+        return await self._aread(path, dtype, size, self._get(path, dtype))
+
+    async def aread_from(self, path, dtype, offset):
+        # Returns the total number of rows and the rows from the offset on.
+        # Misses only fetch these rows instead of the whole file, because
+        # columns larger than the cache would otherwise be downloaded in full
+        # on every poll.
+        dtype = np.dtype(dtype)
+        size = await self.fs.asize(path)
+        entry = self._get(path, dtype)
+        if entry or not offset:
+            table = await self._aread(path, dtype, size, entry)
+            return len(table), table[offset:]
+        metrics.cache.inc(cache='column', result='range')
+        stop = size // dtype.itemsize * dtype.itemsize
+        start = min(offset * dtype.itemsize, stop)
+        async with await self.fs.aopen(path, start, stop) as f:
+            buffer = await f.read(stop - start)
+        rows = np.frombuffer(buffer, dtype, len(buffer) // dtype.itemsize)
+        return start // dtype.itemsize + len(rows), rows
+
+    def _get(self, path, dtype):
+        with self.lock:
+            entry = self.entries.get(path)
+            if not entry or entry[0] != dtype:
+                return None
+            self.entries.move_to_end(path)
+            return entry
+
+    async def _aread(self, path, dtype, size, entry):
+        if entry and size == entry[1]:
+            metrics.cache.inc(cache='column', result='hit')
+            return entry[2]
+        if entry and size > entry[1]:
+            metrics.cache.inc(cache='column', result='append')
+            table = entry[2]
+            used = len(table) * dtype.itemsize
+            async with await self.fs.aopen(path, used, size) as f:
+                buffer = await f.read(size - used)
+            new = np.frombuffer(buffer, dtype, len(buffer) // dtype.itemsize)
+            table = np.concatenate([table, new])
+        else:
+            metrics.cache.inc(cache='column', result='miss')
+            buffer = await self.fs.aread(path)
+            table = np.frombuffer(buffer, dtype, len(buffer) // dtype.itemsize)
+        # Use the number of bytes actually read, in case the file grew in the
+        # meantime, so the next hit fetches the remaining rows.
+        self._store(path, dtype, len(table) * dtype.itemsize, table)
+        return table
+
+    def _store(self, path, dtype, size, table):
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if old:
+                self.nbytes -= old[2].nbytes
+            if table.nbytes > self.maxbytes:
+                return
+            self.entries[path] = (dtype, size, table)
+            self.nbytes += table.nbytes
+            while self.nbytes > self.maxbytes:
+                _, (_, _, evicted) = self.entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                metrics.cache.inc(cache='column', result='eviction')
@@ -0,0 +1,107 @@
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+TYPES = (
+    b'application/json',
+    b'application/x-ndjson',
+    b'application/octet-stream',
+)
+
+
+class CompressMiddleware:
+    # Compresses column and JSON responses, including streamed ones, with
+    # brotli if installed and requested by the client, otherwise with gzip.
+    # Media files are served as they are, because they are compressed already
+    # and need to support range requests.
+
+    def __init__(self, app, minimum_size=1024, level=6):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.level = level
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        accept = dict(scope['headers']).get(b'accept-encoding', b'')
+        accept = {x.split(b';')[0].strip() for x in accept.split(b',')}
+        if brotli and b'br' in accept:
+            encoding = 'br'
+        elif b'gzip' in accept:
+            encoding = 'gzip'
+        else:
+            return await self.app(scope, receive, send)
+        start = None
+        compressor = None
+
+        async def wrapped(message):
+            nonlocal start, compressor
+            if message['type'] == 'http.response.start':
+                start = message
+                return
+            if message['type'] != 'http.response.body':
+                return await send(message)
+            body = message.get('body', b'')
+            more = message.get('more_body', False)
+            if start:
+                headers = dict(start['headers'])
+                ctype = headers.get(b'content-type', b'').split(b';')[0]
+                small = not more and len(body) < self.minimum_size
+                if (
+                    ctype not in TYPES
+                    or b'content-encoding' in headers
+                    or small
+                ):
+                    await send(start)
+                    start = None
+                    return await send(message)
+                compressor = Compressor(encoding, self.level)
+                await send({**start, 'headers': _headers(start, encoding)})
+                start = None
+            if not compressor:
+                return await send(message)
+            body = compressor.compress(body)
+            if not more:
+                body += compressor.flush()
+            await send({**message, 'body': body})
+
+        await self.app(scope, receive, wrapped)
+
+
+class Compressor:
+    def __init__(self, encoding, level):
+        self.encoding = encoding
+        if encoding == 'br':
+            self.impl = brotli.Compressor(quality=level)
+        else:
+            self.impl = zlib.compressobj(level, zlib.DEFLATED, 16 + 15)
+
+    def compress(self, data):
+        if self.encoding == 'br':
+            return self.impl.process(data) + self.impl.flush()
+        # Flush so that streamed lines reach the client without delay.
+        return self.impl.compress(data) + self.impl.flush(zlib.Z_SYNC_FLUSH)
+
+    def flush(self):
+        if self.encoding == 'br':
+            return self.impl.finish()
+        return self.impl.flush()
+
+
+def _headers(start, encoding):
+    # The compressed body has a different length. Its ETag becomes weak,
+    # because the bytes depend on the encoding.
+    headers = []
+    for key, value in start['headers']:
+        if key == b'content-length':
+            continue
+        if key == b'etag' and not value.startswith(b'W/'):
+            value = b'W/' + value
+        headers.append((key, value))
+    headers.append((b'content-encoding', encoding.encode()))
+    headers.append((b'vary', b'accept-encoding'))
+    return headers
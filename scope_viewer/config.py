@@ -2,15 +2,22 @@ import os
 
 import elements
 
-
 config = elements.Flags(
     port=int(os.environ.get('SCOPE_PORT', 8000)),
     basedir=os.environ.get('SCOPE_BASEDIR', ''),
     filesystem=os.environ.get('SCOPE_FILESYSTEM', 'elements'),
     cachedir='/tmp/scope-cache',
     cachesize=int(4e9),  # 4 GB
+    colcache=int(4e9),  # 4 GB shared by all workers
+    listttl=30,  # Seconds
+    listmaxage=3600,  # Seconds
+    listlog='/tmp/scope-listcache.log',
+    catalog='',  # SQLite file of the run catalog, disabled if empty
+    crawlinterval=300,  # Seconds
     maxdepth=2,
     workers=32,
+    readers=16,
+    servertiming=False,
     debug=False,
 ).parse()
 
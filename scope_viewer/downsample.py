@@ -0,0 +1,56 @@
+import numpy as np
+
+
+def downsample(steps, values, points, method='minmax'):
+    if points is None or len(steps) <= points:
+        return steps, values
+    fn = {'minmax': minmax, 'lttb': lttb}[method]
+    indices = fn(steps, values, points)
+    return steps[indices], values[indices]
+
+
+def step_range(steps, values, lo=None, hi=None):
+    # Steps are not necessarily sorted because runs can restore checkpoints.
+    mask = np.ones(len(steps), bool)
+    if lo is not None:
+        mask &= steps >= lo
+    if hi is not None:
+        mask &= steps <= hi
+    return steps[mask], values[mask]
+
+
+def minmax(steps, values, points):
+    # Keep the minimum and maximum of each bucket to preserve the envelope.
+    buckets = max(1, points // 2)
+    size = -(-len(values) // buckets)
+    padded = np.full(buckets * size, np.nan)
+    padded[: len(values)] = values
+    padded = padded.reshape(buckets, size)
+    offsets = np.arange(buckets) * size
+    lows = np.where(np.isnan(padded), np.inf, padded).argmin(1) + offsets
+    highs = np.where(np.isnan(padded), -np.inf, padded).argmax(1) + offsets
+    indices = np.unique(np.concatenate([[0], lows, highs, [len(values) - 1]]))
+    return indices[indices < len(values)]
+
+
+def lttb(steps, values, points):
+    # Largest-Triangle-Three-Buckets: Select the point per bucket that forms
+    # the largest triangle with the previous selection and the next bucket.
+    points = max(3, points)
+    xs = steps.astype(np.float64)
+    ys = np.nan_to_num(values, nan=0.0, posinf=0.0, neginf=0.0)
+    edges = np.linspace(1, len(xs) - 1, points - 1).astype(np.int64)
+    indices = np.zeros(points, np.int64)
+    indices[-1] = len(xs) - 1
+    prev = 0
+    for i in range(points - 2):
+        lo, hi = edges[i], max(edges[i] + 1, edges[i + 1])
+        nlo, nhi = hi, max(hi + 1, edges[min(i + 2, points - 2)])
+        nx, ny = xs[nlo:nhi].mean(), ys[nlo:nhi].mean()
+        areas = np.abs(
+            (xs[prev] - nx) * (ys[lo:hi] - ys[prev])
+            - (xs[prev] - xs[lo:hi]) * (ny - ys[prev])
+        )
+        prev = lo + int(areas.argmax())
+        indices[i + 1] = prev
+    return np.unique(indices)
@@ -1,14 +1,124 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import fcntl
 import io
 import os
 import pathlib
+import sqlite3
 import subprocess
+import threading
+import time
+import types
+import zlib
 
 import elements
 
+import metrics
+
+
+class Async:
+    # Async interface with alist(), alist_sizes(), asize(), aread(), and
+    # aopen(). By default, it runs the blocking methods on a thread pool of
+    # the filesystem. The limit bounds the number of concurrent storage calls
+    # per filesystem.
+
+    limit = 32
+
+    @property
+    def semaphore(self):
+        if '_semaphore' not in self.__dict__:
+            self._semaphore = asyncio.Semaphore(self.limit)
+            self._executor = concurrent.futures.ThreadPoolExecutor(self.limit)
+        return self._semaphore
+
+    async def alist(self, path):
+        with self._timer('list'):
+            return await self._athread(self.list, path)
+
+    async def alist_sizes(self, path):
+        with self._timer('list'):
+            return await self._athread(self.list_sizes, path)
+
+    async def asize(self, path):
+        with self._timer('size'):
+            return await self._athread(self.size, path)
+
+    async def aread(self, path):
+        with self._timer('read'):
+            buffer = await self._athread(self.read, path)
+        self._count(len(buffer))
+        return buffer
+
+    async def aopen(self, path, seek=0, limit=None):
+        with self._timer('open'):
+            f = await self._athread(self.open, path, seek, limit)
+        return AsyncFile(self, f)
+
+    async def aexists(self, path):
+        try:
+            await self.asize(path)
+            return True
+        except (OSError, RuntimeError):
+            return False
+
+    async def asizes(self, path, names):
+        # Returns the sizes of files in the folder from a single listing.
+        # Missing files, such as tables that no rows were written to yet,
+        # have size zero.
+        sizes = dict(await self.alist_sizes(path))
+        return [sizes.get(f'{path}/{x}') or 0 for x in names]
+
+    async def _athread(self, fn, *args):
+        async with self.semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, fn, *args)
+
+    def _timer(self, op):
+        backend = type(self).__name__
+        return metrics.storage_seconds.time('storage', backend=backend, op=op)
+
+    def _count(self, nbytes):
+        metrics.storage_bytes.inc(nbytes, backend=type(self).__name__)
+
+
+class AsyncFile:
+    def __init__(self, fs, f):
+        self.fs = fs
+        self.f = f
+
+    async def read(self, size=-1):
+        # Buffered files were already counted when they were fetched.
+        if isinstance(self.f, io.BytesIO):
+            return self.f.read(size)
+        with self.fs._timer('read'):
+            buffer = await self.fs._athread(self.f.read, size)
+        self.fs._count(len(buffer))
+        return buffer
+
+    async def close(self):
+        self.f.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+class Local(Async):
+    limit = 64
 
-class Local:
     def list(self, path):
-        return os.listdir(path)
+        return [os.path.join(path, x) for x in os.listdir(path)]
+
+    def list_sizes(self, path):
+        # Returns the children with their sizes, or None for folders.
+        with os.scandir(path) as entries:
+            return [
+                (x.path, None if x.is_dir() else x.stat().st_size)
+                for x in entries
+            ]
 
     def size(self, path):
         return os.path.getsize(path)
@@ -23,11 +133,15 @@ class Local:
         return f
 
 
-class Elements:
+class Elements(Async):
     def list(self, path):
         paths = elements.Path(path).glob('*')
         return [str(x) for x in paths]
 
+    def list_sizes(self, path):
+        paths = elements.Path(path).glob('*')
+        return [(str(x), None if x.isdir() else x.size) for x in paths]
+
     def size(self, path):
         return elements.Path(path).size
 
@@ -40,15 +154,22 @@ class Elements:
         return f
 
 
-class Fileutil:
+class Fileutil(Async):
+    # Runs the commands as async subprocesses, so that many slow storage calls
+    # can be pending without occupying threads.
+
+    limit = 16
+
     def __init__(
         self,
         ls='fileutil ls {}',
+        lsl='fileutil ls -l {}',
         cat='fileutil cat {}',
         size="fileutil ls -l {} | tr -s ' ' | cut -d' ' -f5",
         catrange='fileutil cat -input_startpos={} -input_endpos={} {}',
     ):
         self._ls = ls
+        self._lsl = lsl
         self._cat = cat
         self._size = size
         self._catrange = catrange
@@ -61,6 +182,10 @@ class Fileutil:
             print(e)
             return []
 
+    def list_sizes(self, path):
+        output = self._sh(self._lsl.format(path))
+        return self._parse_sizes(output)
+
     def size(self, path):
         output = self._sh(self._size.format(path))
         return int(output.decode('utf-8').strip('\n'))
@@ -69,11 +194,76 @@ class Fileutil:
         return self._sh(self._cat.format(path))
 
     def open(self, path, seek=0, limit=None):
-        limit = limit or self._size(path)
+        limit = limit or self.size(path)
         buffer = self._sh(self._catrange.format(seek, limit, path))
         return io.BytesIO(buffer)
 
+    async def alist(self, path):
+        try:
+            with self._timer('list'):
+                output = await self._ash(self._ls.format(path))
+            return [x.rstrip('/') for x in output.decode('utf-8').splitlines()]
+        except RuntimeError as e:
+            print(e)
+            return []
+
+    async def alist_sizes(self, path):
+        with self._timer('list'):
+            output = await self._ash(self._lsl.format(path))
+        return self._parse_sizes(output)
+
+    async def asize(self, path):
+        with self._timer('size'):
+            output = await self._ash(self._size.format(path))
+        return int(output.decode('utf-8').strip('\n'))
+
+    async def aread(self, path):
+        with self._timer('read'):
+            buffer = await self._ash(self._cat.format(path))
+        self._count(len(buffer))
+        return buffer
+
+    async def aopen(self, path, seek=0, limit=None):
+        limit = limit or await self.asize(path)
+        with self._timer('open'):
+            buffer = await self._ash(self._catrange.format(seek, limit, path))
+        self._count(len(buffer))
+        return AsyncFile(self, io.BytesIO(buffer))
+
+    async def _ash(self, cmd):
+        metrics.subprocesses.inc(backend=type(self).__name__)
+        async with self.semaphore:
+            if '|' in cmd:
+                process = await asyncio.create_subprocess_shell(
+                    cmd,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                )
+            else:
+                process = await asyncio.create_subprocess_exec(
+                    *cmd.split(), stdout=subprocess.PIPE
+                )
+            out, err = await process.communicate()
+            if process.returncode:
+                raise RuntimeError((process.returncode, out, err))
+            return out
+
+    def _parse_sizes(self, output):
+        # The size is the fifth field and the path the last one. Folders end
+        # with a slash.
+        children = []
+        for line in output.decode('utf-8').splitlines():
+            fields = line.split()
+            if not fields:
+                continue
+            if fields[-1].endswith('/'):
+                children.append((fields[-1].rstrip('/'), None))
+            else:
+                children.append((fields[-1], int(fields[4])))
+        return children
+
     def _sh(self, cmd):
+        metrics.subprocesses.inc(backend=type(self).__name__)
         if '|' in cmd:
             process = subprocess.Popen(
                 cmd,
@@ -92,21 +282,266 @@ class Fileutil:
                 raise RuntimeError(f'Error in subprocess: {e}')
 
 
-class WithFileCache:
-    def __init__(self, fs, cachedir, maxsize):
-        # Cache size can be exceeded if multiple workers download in parallel.
+class FsPath:
+    # Minimal pathlib interface on top of a filesystem for reading tables.
+
+    def __init__(self, fs, path):
+        self.fs = fs
+        self.path = path
+
+    def __truediv__(self, name):
+        return FsPath(self.fs, f'{self.path}/{name}')
+
+    def __str__(self):
+        return self.path
+
+    @property
+    def name(self):
+        return self.path.rsplit('/', 1)[-1]
+
+    @property
+    def parent(self):
+        return FsPath(self.fs, self.path.rsplit('/', 1)[0])
+
+    def exists(self):
+        try:
+            self.fs.size(self.path)
+            return True
+        except (OSError, RuntimeError):
+            return False
+
+    def stat(self):
+        return types.SimpleNamespace(st_size=self.fs.size(self.path))
+
+    def read_bytes(self):
+        return self.fs.read(self.path)
+
+    def open(self, mode='rb'):
+        assert mode == 'rb', mode
+        return RangeFile(self.fs, self.path)
+
+
+class RangeFile:
+    # Reads byte ranges at the current position instead of opening the whole
+    # file, because some filesystems fetch all bytes up to the limit on open.
+
+    def __init__(self, fs, path):
+        self.fs = fs
+        self.path = path
+        self.pos = 0
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.fs.size(self.path)
+        self.pos = offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        if size == 0:
+            return b''
+        if size is None or size < 0:
+            size, limit = -1, None
+        else:
+            limit = self.pos + size
+        f = self.fs.open(self.path, self.pos, limit)
+        try:
+            buffer = f.read(size)
+        finally:
+            f.close()
+        self.pos += len(buffer)
+        return buffer
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class WithListCache(Async):
+    # Caches directory listings, which dominate run discovery on slow storage.
+    # Listings younger than ttl are returned directly. Older listings up to
+    # maxage are returned as well but refreshed in the background. Refreshes
+    # go through the wrapped filesystem and its bounded executor. Each server
+    # worker has its own cache, so invalidations are appended to a shared log
+    # file that every worker checks before using its listings.
+
+    def __init__(self, fs, ttl=30, maxage=3600, logfile=None, maxlog=1e6):
+        self.fs = fs
+        self.ttl = ttl
+        self.maxage = maxage
+        self.entries = {}
+        self.pending = {}
+        self.logfile = logfile and pathlib.Path(logfile)
+        self.maxlog = maxlog
+        self.logpos = self._logsize()
+
+    def list(self, path):
+        self._sync()
+        entry = self.entries.get(path)
+        if entry and time.monotonic() - entry[0] < self.ttl:
+            return entry[1]
+        children = self.fs.list(path)
+        self.entries[path] = (time.monotonic(), children)
+        return children
+
+    def list_sizes(self, path):
+        return self.fs.list_sizes(path)
+
+    def size(self, path):
+        return self.fs.size(path)
+
+    def read(self, path):
+        return self.fs.read(path)
+
+    def open(self, path, seek=0, limit=None):
+        return self.fs.open(path, seek, limit)
+
+    async def alist(self, path):
+        self._sync()
+        entry = self.entries.get(path)
+        age = entry and time.monotonic() - entry[0]
+        if entry and age < self.ttl:
+            metrics.cache.inc(cache='list', result='hit')
+            return entry[1]
+        if entry and age < self.maxage:
+            metrics.cache.inc(cache='list', result='stale')
+            self._refresh(path)
+            return entry[1]
+        metrics.cache.inc(cache='list', result='miss')
+        # Shield the shared refresh from cancellation of a single request.
+        return await asyncio.shield(self._refresh(path))
+
+    async def alist_sizes(self, path):
+        return await self.fs.alist_sizes(path)
+
+    async def asize(self, path):
+        return await self.fs.asize(path)
+
+    async def aread(self, path):
+        return await self.fs.aread(path)
+
+    async def aopen(self, path, seek=0, limit=None):
+        return await self.fs.aopen(path, seek, limit)
+
+    def invalidate(self, prefix=None):
+        # Removes the listing of the folder and all folders below it, in this
+        # and all other processes that share the log file.
+        self._invalidate(prefix)
+        if not self.logfile:
+            return
+        if self._logsize() > self.maxlog:
+            # Other processes see the log shrink and drop all listings.
+            self.logfile.write_bytes(b'')
+        # Appends of single short lines are atomic.
+        with self.logfile.open('a') as f:
+            f.write((prefix or '') + '\n')
+
+    def _invalidate(self, prefix=None):
+        if prefix is None:
+            self.entries.clear()
+            return
+        prefix = prefix.rstrip('/')
+        for path in list(self.entries):
+            if path == prefix or path.startswith(prefix + '/'):
+                del self.entries[path]
+
+    def _sync(self):
+        # Applies invalidations that other processes appended to the log.
+        if not self.logfile:
+            return
+        size = self._logsize()
+        if size == self.logpos:
+            return
+        if size < self.logpos:
+            self._invalidate(None)
+            self.logpos = size
+            return
+        with self.logfile.open('rb') as f:
+            f.seek(self.logpos)
+            buffer = f.read(size - self.logpos)
+        # Only consume complete lines.
+        buffer = buffer[: buffer.rfind(b'\n') + 1]
+        self.logpos += len(buffer)
+        for line in buffer.decode('utf-8').splitlines():
+            self._invalidate(line or None)
+
+    def _logsize(self):
+        try:
+            return self.logfile.stat().st_size if self.logfile else 0
+        except FileNotFoundError:
+            return 0
+
+    def _refresh(self, path):
+        if path not in self.pending:
+            task = asyncio.ensure_future(self._fetch(path))
+            task.add_done_callback(lambda x: x.cancelled() or x.exception())
+            task.add_done_callback(lambda x: self.pending.pop(path, None))
+            self.pending[path] = task
+        return self.pending[path]
+
+    async def _fetch(self, path):
+        children = await self.fs.alist(path)
+        self.entries[path] = (time.monotonic(), children)
+        return children
+
+
+class WithFileCache(Async):
+    # Downloads files into a local folder shared by all server workers. An
+    # SQLite index tracks the size and last access of every file together with
+    # their total, so eviction does not need to scan the folder. Downloads of
+    # the same file are single-flight within a process and across workers via
+    # file locks, and files are written atomically via rename.
+
+    def __init__(self, fs, cachedir, maxsize, stripes=1024, touch=60):
         assert not isinstance(fs, Local)
         if isinstance(cachedir, str):
             cachedir = pathlib.Path(cachedir)
-        cachedir.mkdir(exist_ok=True, parents=True)
+        (cachedir / '.locks').mkdir(exist_ok=True, parents=True)
         self.fs = fs
         self.localfs = Local()
         self.cachedir = cachedir
         self.maxsize = maxsize
+        self.stripes = stripes
+        self.touch = touch
+        self.touched = {}
+        self.local = threading.local()
+        self.pending = {}
+        with self._transaction() as db:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS files '
+                '(name TEXT PRIMARY KEY, size INTEGER, atime REAL)'
+            )
+            db.execute('CREATE INDEX IF NOT EXISTS lru ON files (atime)')
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS total (id INTEGER PRIMARY KEY, '
+                'size INTEGER)'
+            )
+            if not db.execute('SELECT size FROM total').fetchone():
+                # Index files that were cached before the index existed.
+                files = [x for x in cachedir.glob('*') if x.name[0] != '.']
+                stats = [(x.name, x.stat()) for x in files]
+                db.executemany(
+                    'INSERT OR IGNORE INTO files VALUES (?, ?, ?)',
+                    [(n, x.st_size, x.st_atime) for n, x in stats],
+                )
+                total = sum(x.st_size for _, x in stats)
+                db.execute('INSERT INTO total VALUES (0, ?)', (total,))
 
     def list(self, path):
         return self.fs.list(path)
 
+    def list_sizes(self, path):
+        return self.fs.list_sizes(path)
+
     def size(self, path):
         localpath = self._getfile(path)
         return self.localfs.size(localpath)
@@ -119,28 +554,186 @@ class WithFileCache:
         localpath = self._getfile(path)
         return self.localfs.open(localpath, seek, limit)
 
+    async def alist(self, path):
+        return await self.fs.alist(path)
+
+    async def alist_sizes(self, path):
+        return await self.fs.alist_sizes(path)
+
+    async def asize(self, path):
+        localpath = await self._agetfile(path)
+        return await self.localfs.asize(localpath)
+
+    async def aread(self, path):
+        localpath = await self._agetfile(path)
+        return await self.localfs.aread(localpath)
+
+    async def aopen(self, path, seek=0, limit=None):
+        localpath = await self._agetfile(path)
+        return await self.localfs.aopen(localpath, seek, limit)
+
+    async def aderive(self, key, produce):
+        # Caches assets derived from files, such as thumbnails, next to the
+        # downloaded files. The produce coroutine function creates the bytes.
+        localpath = await self._agetfile(key, produce)
+        return await self.localfs.aread(localpath)
+
     def _getfile(self, path):
+        localpath = self._localpath(path)
+        if self._hit(localpath):
+            metrics.cache.inc(cache='file', result='hit')
+            return localpath
+        metrics.cache.inc(cache='file', result='miss')
+        with self._flock(localpath):
+            if not self._hit(localpath):
+                self._store(localpath, self.fs.read(path))
+        return localpath
+
+    async def _agetfile(self, path, produce=None):
+        localpath = self._localpath(path)
+        if await self._athread(self._hit, localpath):
+            metrics.cache.inc(cache='file', result='hit')
+            return localpath
+        metrics.cache.inc(cache='file', result='miss')
+        # Coroutines wait on an asyncio lock rather than a file lock so that
+        # they do not block threads while another download is in flight.
+        lock, count = self.pending.get(localpath.name, (asyncio.Lock(), 0))
+        self.pending[localpath.name] = (lock, count + 1)
+        try:
+            async with lock:
+                if await self._athread(self._hit, localpath):
+                    return localpath
+                # Derived assets are produced before taking the file lock,
+                # because producing them reads the source file through this
+                # cache, whose lock can share the same stripe.
+                buffer = produce and await produce()
+                async with self._aflock(localpath):
+                    if not await self._athread(self._hit, localpath):
+                        if not produce:
+                            buffer = await self.fs.aread(path)
+                        await self._athread(self._store, localpath, buffer)
+        finally:
+            lock, count = self.pending.pop(localpath.name)
+            if count > 1:
+                self.pending[localpath.name] = (lock, count - 1)
+        return localpath
+
+    def _localpath(self, path):
         name = str(path).replace(':', '').replace('//', '/').replace('/', ':')
-        localpath = self.cachedir / name
+        return self.cachedir / name
+
+    def _hit(self, localpath):
         if not localpath.exists():
-            buffer = self.fs.read(path)
-            self._freeup(len(buffer), path)
-            localpath.write_bytes(buffer)
-        return localpath
+            return False
+        # Updating the access time takes the write lock of the index, so each
+        # process does it at most once per touch interval and file. Eviction
+        # only needs the access order to be roughly right.
+        now = time.time()
+        if now - self.touched.get(localpath.name, 0) < self.touch:
+            return True
+        self.touched[localpath.name] = now
+        if len(self.touched) > 100000:
+            self.touched.clear()
+        with self._transaction() as db:
+            db.execute(
+                'UPDATE files SET atime = ? WHERE name = ?',
+                (now, localpath.name),
+            )
+        return True
 
-    def _freeup(self, needed, path):
-        # Catch errors because parallel workers share the cache.
-        pairs = []
-        for path in self.cachedir.glob('*'):
-            try:
-                stat = path.stat()
-                pairs.append((path, stat))
-            except FileNotFoundError:
-                pass
-        pairs = sorted(pairs, key=lambda x: x[1].st_ctime)
-        while sum([s.st_size for p, s in pairs]) + needed > self.maxsize:
-            path, _ = pairs.pop(0)
-            try:
-                path.unlink()
-            except IndexError:
-                pass
+    def _store(self, localpath, buffer):
+        tmppath = localpath.with_name(f'.{localpath.name}.{os.getpid()}.tmp')
+        tmppath.write_bytes(buffer)
+        with self._transaction() as db:
+            (total,) = db.execute('SELECT size FROM total').fetchone()
+            rows = db.execute('SELECT name, size FROM files ORDER BY atime')
+            evicted = []
+            for name, size in rows:
+                if total + len(buffer) <= self.maxsize:
+                    break
+                evicted.append(name)
+                total -= size
+            rows.close()
+            db.executemany(
+                'DELETE FROM files WHERE name = ?', [(x,) for x in evicted]
+            )
+            db.execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?)',
+                (localpath.name, len(buffer), time.time()),
+            )
+            db.execute('UPDATE total SET size = ?', (total + len(buffer),))
+            for name in evicted:
+                (self.cachedir / name).unlink(missing_ok=True)
+            metrics.cache.inc(len(evicted), cache='file', result='eviction')
+            os.replace(tmppath, localpath)
+
+    def _flock(self, localpath):
+        stripe = zlib.crc32(localpath.name.encode('utf-8')) % self.stripes
+        return FileLock(self.cachedir / '.locks' / str(stripe))
+
+    @contextlib.asynccontextmanager
+    async def _aflock(self, localpath):
+        # Polls the file lock instead of waiting for it on the executor. A
+        # waiting thread would hold one of its slots, which the coroutine that
+        # holds the lock needs to finish its download and release the lock.
+        flock = self._flock(localpath)
+        delay = 0.001
+        while not flock.acquire(blocking=False):
+            await asyncio.sleep(delay)
+            delay = min(2 * delay, 0.05)
+        try:
+            yield
+        finally:
+            flock.release()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # Connections are per thread. Transactions take the write lock up
+        # front, so that workers update the total one at a time.
+        if not hasattr(self.local, 'db'):
+            self.local.db = sqlite3.connect(
+                self.cachedir / '.index.sqlite',
+                timeout=60,
+                isolation_level=None,
+            )
+            self.local.db.execute('PRAGMA journal_mode = WAL')
+            # With WAL, this keeps the index consistent and avoids syncing
+            # the disk on every commit. Only the latest commits can be lost
+            # on power failure.
+            self.local.db.execute('PRAGMA synchronous = NORMAL')
+        db = self.local.db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+
+class FileLock:
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+
+    def acquire(self, blocking=True):
+        f = open(self.path, 'a')  # noqa: SIM115
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            f.close()
+            return False
+        self.f = f
+        return True
+
+    def release(self):
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+        self.f = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
@@ -0,0 +1,130 @@
+import contextlib
+import contextvars
+import threading
+import time
+
+# Durations of the current request by phase, for the Server-Timing header.
+timings = contextvars.ContextVar('timings', default=None)
+
+REGISTRY = []
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[x]) for x in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}']
+        lines.append(f'# TYPE {self.name} counter')
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{_labels(self.labels, key)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[x]) for x in self.labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+            counts, _, _ = entry = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            entry[1] += 1
+            entry[2] += value
+
+    @contextlib.contextmanager
+    def time(self, phase=None, **labels):
+        # Also adds the duration to the current request under the phase name.
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            self.observe(duration, **labels)
+            current = timings.get()
+            if phase and current is not None:
+                current[phase] = current.get(phase, 0.0) + duration
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}']
+        lines.append(f'# TYPE {self.name} histogram')
+        with self.lock:
+            for key, (counts, count, total) in sorted(self.values.items()):
+                for bound, value in zip(self.buckets, counts):
+                    labels = _labels((*self.labels, 'le'), (*key, bound))
+                    lines.append(f'{self.name}_bucket{labels} {value}')
+                labels = _labels((*self.labels, 'le'), (*key, '+Inf'))
+                lines.append(f'{self.name}_bucket{labels} {count}')
+                labels = _labels(self.labels, key)
+                lines.append(f'{self.name}_sum{labels} {total}')
+                lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = [f'{k}="{_escape(v)}"' for k, v in zip(names, values)]
+    return '{' + ','.join(pairs) + '}'
+
+
+def _escape(value):
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    return value.replace('\n', '\\n')
+
+
+requests = Histogram(
+    'scope_request_seconds',
+    'Time until the response headers of API requests.',
+    ('endpoint', 'method', 'status'),
+)
+storage_seconds = Histogram(
+    'scope_storage_seconds',
+    'Duration of filesystem calls.',
+    ('backend', 'op'),
+)
+storage_bytes = Counter(
+    'scope_storage_read_bytes_total',
+    'Bytes read from filesystems.',
+    ('backend',),
+)
+subprocesses = Counter(
+    'scope_subprocesses_total',
+    'Subprocesses started by filesystems.',
+    ('backend',),
+)
+cache = Counter(
+    'scope_cache_total',
+    'Cache lookups and evictions by cache and result.',
+    ('cache', 'result'),
+)
@@ -1,25 +1,79 @@
+import asyncio
 import concurrent.futures
+import contextlib
 import functools
+import hashlib
 import pathlib
 import struct
 import sys
+import time
+import typing
 
 import fastapi
 import fastapi.responses
 import fastapi.staticfiles
+import numpy as np
+import orjson
+import PIL.Image
+import pydantic
+
+import scope
 
 sys.path.insert(0, str(pathlib.Path(__file__).parent))
 
-import filesystems
+import aggregate
+import catalog
+import colcache
+import compress
 import config
-
+import downsample
+import filesystems
+import metrics
 
 config = config.config
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    crawler = runcatalog and runcatalog.start()
+    yield
+    crawler and crawler.cancel()
+
+
 app = fastapi.FastAPI(
     debug=config.debug,
+    lifespan=lifespan,
     # Support extended JSON (NaN, Inf, -Inf).
     default_response_class=fastapi.responses.ORJSONResponse,
 )
+app.add_middleware(compress.CompressMiddleware)
+
+
+@app.middleware('http')
+async def timing(request: fastapi.Request, call_next):
+    # Measures the time until the response headers are ready. Handlers and
+    # filesystems add phases such as storage to the timings of the request.
+    current = {}
+    metrics.timings.set(current)
+    start = time.perf_counter()
+    response = await call_next(request)
+    duration = time.perf_counter() - start
+    route = request.scope.get('route')
+    endpoint = getattr(route, 'path', None) or 'static'
+    metrics.requests.observe(
+        duration,
+        endpoint=endpoint,
+        method=request.method,
+        status=response.status_code,
+    )
+    if config.servertiming:
+        entries = {**current, 'total': duration}
+        response.headers['server-timing'] = ', '.join(
+            f'{k};dur={1000 * v:.1f}' for k, v in entries.items()
+        )
+    return response
+
+
 basedir = config.basedir.rstrip('/')
 fs = dict(
     elements=filesystems.Elements,
@@ -33,118 +87,575 @@ if config.cachedir and config.cachesize and not is_local:
 else:
     cachedfs = fs
 
+listfs = filesystems.WithListCache(
+    fs, config.listttl, config.listmaxage, config.listlog
+)
+# Every worker process has its own column cache.
+workers = 1 if config.debug else config.workers
+columns = colcache.ColumnCache(fs, config.colcache // workers)
+# Whether float columns have a pyramid, together with the column version it
+# was checked for.
+pyramids = {}
+readers = concurrent.futures.ThreadPoolExecutor(config.readers)
+
+BINARY = 'application/octet-stream'
+
 
 @app.get('/api/exps')
-def get_exps():
+async def get_exps():
     print('GET /exps', flush=True)
-    folders = fs.list(basedir)
+    folders = await listfs.alist(basedir)
     expids = [x.rsplit('/', 1)[-1] for x in folders]
     return {'exps': expids}
 
 
 @app.get('/api/exp/{expid}')
-def get_exp(expid: str):
+async def get_exp(expid: str):
     print(f'GET /exp/{expid}', flush=True)
-    folders = find_runs(basedir + '/' + expid)
+    folders = await find_runs(basedir + '/' + expid)
     folders = [x.removeprefix(str(basedir))[1:] for x in folders]
     runids = [x.replace('/', ':') for x in folders]
     return {'id': expid, 'runs': runids}
 
 
 @app.get('/api/run/{runid}')
-def get_run(runid: str):
+async def get_run(runid: str):
     print(f'GET /run/{runid}', flush=True)
     folder = basedir + '/' + runid.replace(':', '/') + '/scope'
-    children = fs.list(folder)
+    children = await listfs.alist(folder)
+    children = [x for x in children if x.rsplit('/', 1)[-1][0] != '.']
     children = [x.removeprefix(str(basedir))[1:] for x in children]
     colids = [x.replace('/', ':') for x in children]
     return {'id': runid, 'cols': colids}
 
 
 @app.get('/api/col/{colid}')
-def get_col(colid: str):
+async def get_col(
+    request: fastapi.Request,
+    colid: str,
+    max_points: int | None = None,
+    step_range: str | None = None,
+    method: typing.Literal['minmax', 'lttb'] = 'minmax',
+    format: typing.Literal['json', 'bin'] | None = None,
+    offset: int | None = None,
+    since_step: int | None = None,
+):
     print(f'GET /col/{colid}', flush=True)
-    ext = colid.rsplit('.', 1)[-1]
-    path = basedir + '/' + colid.replace(':', '/')
-    runid = colid.rsplit(':', 2)[0]  # Remove metric name and scope folder.
-    if ext == 'float':
-        buffer = fs.read(path)
-        steps, values = tuple(zip(*struct.iter_unpack('>qd', buffer)))
-        return {'id': colid, 'run': runid, 'steps': steps, 'values': values}
-    elif ext in ('txt', 'png', 'jpg', 'jpeg', 'mp4', 'webm'):
-        buffer = fs.read(path + '/index')
-        steps, idents = tuple(zip(*struct.iter_unpack('q8s', buffer)))
-        filenames = [f'{s:020}-{x.hex()}.{ext}' for s, x in zip(steps, idents)]
-        values = [f'{colid}:{x}' for x in filenames]
-        return {'id': colid, 'run': runid, 'steps': steps, 'values': values}
-    else:
-        raise NotImplementedError((colid, ext))
+    binary = is_binary(request, format)
+    # Columns only grow by appending, so their file sizes identify the
+    # content. Clients still revalidate on every request.
+    version = await col_version(colid)
+    params = (max_points, step_range, method, binary, offset, since_step)
+    headers = {
+        'etag': make_etag(colid, version, *params),
+        'cache-control': 'no-cache',
+        'vary': 'accept',
+    }
+    if not_modified(request, headers['etag']):
+        return fastapi.Response(status_code=304, headers=headers)
+    result = await read_col(
+        colid, max_points, step_range, method, offset, since_step, version
+    )
+    if binary:
+        content = encode_binary(result)
+        return fastapi.Response(content, media_type=BINARY, headers=headers)
+    return fastapi.responses.ORJSONResponse(
+        encode_json(result), headers=headers
+    )
+
+
+class ColsRequest(pydantic.BaseModel):
+    cols: list[str]
+    max_points: int | None = None
+    step_range: str | None = None
+    method: typing.Literal['minmax', 'lttb'] = 'minmax'
+    format: typing.Literal['json', 'bin'] | None = None
+    offsets: dict[str, int] = {}
+
+
+@app.post('/api/cols')
+async def get_cols(request: fastapi.Request, body: ColsRequest):
+    # Streams one JSON line or binary frame per column in the order the reads
+    # complete.
+    print(f'POST /cols ({len(body.cols)} cols)', flush=True)
+    parse_step_range(body.step_range)
+    args = (body.max_points, body.step_range, body.method)
+    binary = is_binary(request, body.format)
+
+    async def read(colid):
+        try:
+            return await read_col(colid, *args, body.offsets.get(colid))
+        except Exception as e:  # noqa: BLE001
+            return {'id': colid, 'error': repr(e)}
+
+    async def iterlines():
+        tasks = [asyncio.ensure_future(read(x)) for x in body.cols]
+        try:
+            for task in asyncio.as_completed(tasks):
+                result = await task
+                if binary:
+                    yield encode_binary(result)
+                else:
+                    yield orjson.dumps(encode_json(result)) + b'\n'
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    media_type = BINARY if binary else 'application/x-ndjson'
+    return fastapi.responses.StreamingResponse(
+        iterlines(), media_type=media_type
+    )
+
+
+@app.get('/api/agg')
+async def get_agg(
+    request: fastapi.Request,
+    cols: str,
+    stat: str = 'mean,std',
+    grid: int = fastapi.Query(1000, ge=2, le=100000),
+    step_range: str | None = None,
+    format: typing.Literal['json', 'bin'] | None = None,
+):
+    # Aggregates float columns of multiple runs, e.g. across seeds, on a
+    # common grid of steps. The colids are separated by commas.
+    print(f'GET /agg {cols}', flush=True)
+    colids = [x for x in cols.split(',') if x]
+    try:
+        stats = aggregate.parse_stats(stat)
+    except ValueError as e:
+        raise fastapi.HTTPException(
+            fastapi.status.HTTP_400_BAD_REQUEST, detail=str(e)
+        )
+    lo, hi = parse_step_range(step_range)
+    tables = await asyncio.gather(
+        *[read_floats(x) for x in colids], return_exceptions=True
+    )
+    for colid, table in zip(colids, tables):
+        if not isinstance(table, Exception):
+            continue
+        if isinstance(table, fastapi.HTTPException):
+            raise table
+        if not await fs.aexists(basedir + '/' + colid.replace(':', '/')):
+            raise fastapi.HTTPException(
+                fastapi.status.HTTP_404_NOT_FOUND,
+                detail=f'Column not found: {colid}',
+            )
+        raise table
+    tables = [downsample.step_range(s, v, lo, hi) for _, s, v in tables]
+    steps, results = await blocking(
+        aggregate.aggregate, tables, stats, grid, lo, hi
+    )
+    result = {'cols': colids, 'steps': steps, **results}
+    if is_binary(request, format):
+        return fastapi.Response(encode_binary(result), media_type=BINARY)
+    return encode_json(result)
+
+
+@app.get('/api/catalog/runs')
+async def get_catalog_runs(
+    q: str | None = None,
+    exp: str | None = None,
+    key: str | None = None,
+    min_step: int | None = None,
+    since: float | None = None,
+    sort: typing.Literal[catalog.RUN_SORTS] = 'id',
+    desc: bool = False,
+    limit: int = fastapi.Query(100, ge=0, le=10000),
+    offset: int = fastapi.Query(0, ge=0),
+):
+    print(f'GET /catalog/runs {q}', flush=True)
+    found, total = get_catalog().runs(
+        q, exp, key, min_step, since, sort, desc, limit, offset
+    )
+    return {'runs': found, 'total': total, 'offset': offset}
+
+
+@app.get('/api/catalog/cols')
+async def get_catalog_cols(
+    run: str | None = None,
+    q: str | None = None,
+    key: str | None = None,
+    ext: str | None = None,
+    sort: typing.Literal[catalog.COL_SORTS] = 'id',
+    desc: bool = False,
+    limit: int = fastapi.Query(1000, ge=0, le=100000),
+    offset: int = fastapi.Query(0, ge=0),
+):
+    print(f'GET /catalog/cols {run} {q}', flush=True)
+    found, total = get_catalog().cols(
+        run, q, key, ext, sort, desc, limit, offset
+    )
+    return {'cols': found, 'total': total, 'offset': offset}
+
+
+@app.post('/api/invalidate')
+async def invalidate(id: str | None = None):
+    # Drops cached listings of an experiment or run, or all of them.
+    print(f'POST /invalidate {id}', flush=True)
+    listfs.invalidate(id and basedir + '/' + id.replace(':', '/'))
+    return {'id': id}
 
 
 @app.get('/api/file/{fileid}')
-def get_file(request: fastapi.Request, fileid: str):
+async def get_file(
+    request: fastapi.Request,
+    fileid: str,
+    w: int | None = fastapi.Query(None, gt=0),
+    h: int | None = fastapi.Query(None, gt=0),
+    poster: bool = False,
+):
     print(f'GET /file/{fileid}', flush=True)
+    # File names contain the step and a random identifier, so their content
+    # never changes.
+    headers = {
+        'etag': make_etag(fileid, w, h, poster),
+        'cache-control': 'public, max-age=31536000, immutable',
+    }
+    if not_modified(request, headers['etag']):
+        return fastapi.Response(status_code=304, headers=headers)
     ext = fileid.rsplit('.', 1)[-1]
     path = basedir + '/' + fileid.replace(':', '/')
+    path, offset, length = file_range(path)
     if ext in ('txt',):
-        text = cachedfs.read(path).decode('utf-8')
-        return {'id': fileid, 'text': text}
+        text = (await read_range(path, offset, length)).decode('utf-8')
+        content = {'id': fileid, 'text': text}
+        return fastapi.responses.ORJSONResponse(content, headers=headers)
     elif ext in ('png', 'jpg', 'jpeg'):
-        data = cachedfs.read(path)
-        return fastapi.Response(content=data, media_type=f'image/{ext}')
+        if w or h:
+            fn = functools.partial(thumbnail, ext=ext, w=w, h=h)
+            data = await derive(path, offset, length, f'{w}x{h}.{ext}', fn)
+        else:
+            data = await read_range(path, offset, length)
+        media_type = f'image/{ext}'
+        return fastapi.Response(data, media_type=media_type, headers=headers)
+    elif ext in ('mp4', 'webm') and poster:
+        fn = functools.partial(video_poster, ext=ext, w=w, h=h)
+        data = await derive(path, offset, length, f'poster-{w}x{h}.jpg', fn)
+        media_type = 'image/jpeg'
+        return fastapi.Response(data, media_type=media_type, headers=headers)
     elif ext in ('mp4', 'webm'):
-        filesize = cachedfs.size(path)
-        openfn = functools.partial(cachedfs.open, path)
+        if length is None:
+            length = await cachedfs.asize(path)
+
+        def openfn(start, stop):
+            return cachedfs.aopen(path, offset + start, offset + stop)
+
         content_type = f'video/{ext}'
-        return RangeResponse(request, openfn, filesize, content_type)
+        return RangeResponse(request, openfn, length, content_type, headers)
     else:
         raise NotImplementedError((fileid, ext))
 
 
+@app.get('/metrics')
+async def get_metrics():
+    # Prometheus text format. Every server worker reports its own metrics.
+    return fastapi.responses.PlainTextResponse(
+        metrics.render(), media_type='text/plain; version=0.0.4'
+    )
+
+
 dist = pathlib.Path(__file__).parent / 'dist'
 app.mount('/', fastapi.staticfiles.StaticFiles(directory=dist, html=True))
 
 
-def find_runs(folder, maxdepth=config.maxdepth, workers=64):
-    if not workers:
-        runs = []
-        queue = [(folder, 0)]
-        while queue:
-            node, depth = queue.pop(0)
-            children = fs.list(node)
-            if any(x.endswith('/scope') for x in children):
-                runs.append(node)
-            elif depth < maxdepth:
-                queue += [(x, depth + 1) for x in children]
-        return runs
+async def find_runs(folder, maxdepth=config.maxdepth):
+    # Lists folders concurrently, bounded by the limit of the filesystem.
     runs = []
-    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
-        future = pool.submit(fs.list, folder)
-        future.parent = folder
-        future.depth = 0
-        queue = [future]
-        while queue:
-            current = queue.pop(0)
-            children = current.result()
-            if any(x.endswith('/scope') for x in children):
-                runs.append(current.parent)
-            elif current.depth < maxdepth:
-                for child in children:
-                    future = pool.submit(fs.list, child)
-                    future.parent = child
-                    future.depth = current.depth + 1
-                    queue.append(future)
-    return runs
-
-
-def RangeResponse(request, openfn, filesize, content_type):
+
+    async def visit(node, depth):
+        children = await listfs.alist(node)
+        if any(x.endswith('/scope') for x in children):
+            runs.append(node)
+        elif depth < maxdepth:
+            await asyncio.gather(*[visit(x, depth + 1) for x in children])
+
+    await visit(folder, 0)
+    return sorted(runs)
+
+
+if config.catalog:
+    runcatalog = catalog.Catalog(
+        fs, basedir, config.catalog, find_runs, config.crawlinterval
+    )
+else:
+    runcatalog = None
+
+
+async def read_col(
+    colid,
+    max_points=None,
+    step_range=None,
+    method='minmax',
+    offset=None,
+    since_step=None,
+    version=None,
+):
+    # Returns the column with NumPy arrays for numeric fields, which are
+    # converted by encode_json() or encode_binary(). Columns only grow by
+    # appending rows, so clients can pass the length of their previous result
+    # as offset to only receive the new rows. The total number of rows is
+    # returned as length.
+    ext = colid.rsplit('.', 1)[-1]
+    path = basedir + '/' + colid.replace(':', '/')
+    runid = colid.rsplit(':', 2)[0]  # Remove metric name and scope folder.
+    lo, hi = parse_step_range(step_range)
+    delta = {} if offset is None else {'offset': offset}
+    if ext in ('float', 'cfloat'):
+        column = filesystems.FsPath(fs, path)
+        full = offset is None and since_step is None
+        summary = full and max_points and method == 'minmax'
+        if summary and await has_pyramid(colid, version):
+            return await blocking(
+                get_summary, colid, runid, column, max_points, lo, hi
+            )
+        length, steps, values = await read_floats(colid, offset)
+        if since_step is not None:
+            steps, values = downsample.step_range(
+                steps, values, since_step + 1
+            )
+        steps, values = downsample.step_range(steps, values, lo, hi)
+        steps, values = await blocking(
+            downsample.downsample, steps, values, max_points, method
+        )
+        return {
+            'id': colid,
+            'run': runid,
+            'steps': steps,
+            'values': values,
+            'length': length,
+            **delta,
+        }
+    elif ext in ('txt', 'png', 'jpg', 'jpeg', 'mp4', 'webm'):
+        column = filesystems.FsPath(fs, path)
+        filename, fmt = await blocking(scope.formats.files_index, column)
+        dtype = scope.formats.table_dtype(fmt)
+        table = await columns.aread(str(filename), dtype)
+        length = len(table)
+        table = table[offset:]
+        if since_step is not None:
+            table = table[table['f0'] > since_step]
+        steps, table = downsample.step_range(table['f0'], table, lo, hi)
+        fields = [table[x] for x in dtype.names[1:]]
+        names = scope.formats.files_names(steps, *fields)
+        values = [f'{colid}:{x}.{ext}' for x in names]
+        return {
+            'id': colid,
+            'run': runid,
+            'steps': steps,
+            'values': values,
+            'length': length,
+            **delta,
+        }
+    else:
+        raise NotImplementedError((colid, ext))
+
+
+async def has_pyramid(colid, version=None):
+    # Pyramids of float columns summarize min and max per block. The check is
+    # cached until the column changes, with the version from the caller when
+    # it already has one.
+    if not colid.endswith('.float'):
+        return False
+    if version is None:
+        version = await col_version(colid)
+    cached = pyramids.get(colid)
+    if cached and cached[0] == version:
+        return cached[1]
+    path = basedir + '/' + colid.replace(':', '/')
+    column = filesystems.FsPath(fs, path)
+    exists = await fs.aexists(str(scope.pyramid.folder(column) / '0'))
+    pyramids[colid] = (version, exists)
+    return exists
+
+
+def file_range(path):
+    # Values of packed columns are byte ranges of a shard file.
+    folder, name = path.rsplit('/', 1)
+    packed = scope.formats.files_range(name)
+    if not packed:
+        return path, 0, None
+    shard, offset, length = packed
+    return f'{folder}/{shard}', offset, length
+
+
+async def read_range(path, offset, length):
+    if length is None:
+        return await cachedfs.aread(path)
+    async with await cachedfs.aopen(path, offset, offset + length) as f:
+        return await f.read(length)
+
+
+async def derive(path, offset, length, variant, fn):
+    # Generates derived assets on the readers pool and caches them on disk
+    # next to the downloaded files when a file cache is configured.
+    async def produce():
+        buffer = await read_range(path, offset, length)
+        return await blocking(fn, buffer)
+
+    if isinstance(cachedfs, filesystems.WithFileCache):
+        return await cachedfs.aderive(f'{path}@{offset}-{variant}', produce)
+    return await produce()
+
+
+def thumbnail(buffer, ext, w=None, h=None):
+    fmt = scope.formats.Image(ext)
+    return fmt.encode(resize(fmt.decode(buffer), w, h))
+
+
+def video_poster(buffer, ext, w=None, h=None):
+    frames = scope.formats.Video(ext).decode(buffer, frames=1)
+    return scope.formats.Image('jpg').encode(resize(frames[0], w, h))
+
+
+def resize(image, w=None, h=None):
+    # Fits the image into the bounds while keeping its aspect ratio. Images
+    # are never enlarged.
+    image = PIL.Image.fromarray(image)
+    image.thumbnail((w or image.width, h or image.height))
+    return np.asarray(image)
+
+
+async def col_version(colid):
+    ext = colid.rsplit('.', 1)[-1]
+    path = basedir + '/' + colid.replace(':', '/')
+    if ext == 'float':
+        return (await fs.asize(path),)
+    elif ext == 'cfloat':
+        return tuple(await fs.asizes(path, ('index', 'tail')))
+    else:
+        column = filesystems.FsPath(fs, path)
+        filename, _ = await blocking(scope.formats.files_index, column)
+        return (await fs.asize(str(filename)),)
+
+
+def make_etag(*parts):
+    digest = hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def not_modified(request, etag):
+    header = request.headers.get('if-none-match')
+    if not header:
+        return False
+    # Compression weakens ETags, so compare without the weak prefix.
+    tags = {x.strip().removeprefix('W/') for x in header.split(',')}
+    return '*' in tags or etag in tags
+
+
+async def blocking(fn, *args):
+    # Runs synchronous reads and NumPy work off the event loop.
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(readers, fn, *args)
+
+
+async def read_floats(colid, offset=None):
+    # Reads float columns through the column cache shared by all endpoints.
+    ext = colid.rsplit('.', 1)[-1]
+    path = basedir + '/' + colid.replace(':', '/')
+    if ext == 'cfloat':
+        column = filesystems.FsPath(fs, path)
+        return await blocking(read_compressed, column, offset)
+    elif ext == 'float':
+        length, table = await columns.aread_from(path, '>i8,>f8', offset)
+        return length, table['f0'], table['f1']
+    else:
+        raise fastapi.HTTPException(
+            fastapi.status.HTTP_400_BAD_REQUEST,
+            detail=f'Not a float column: {colid}',
+        )
+
+
+def read_compressed(column, offset=None):
+    fmt = scope.formats.CompressedFloat()
+    length = fmt.length(column)
+    steps, values = fmt.read(column, min(offset or 0, length), length)
+    return length, steps, values
+
+
+def get_summary(colid, runid, column, points, lo=None, hi=None):
+    length = scope.formats.table_length(column, '>qd')
+    bisect = functools.partial(
+        scope.formats.table_bisect, column, '>qd', hi=length
+    )
+    start = 0 if lo is None else bisect(lo)
+    stop = length if hi is None else max(start, bisect(hi + 1))
+    summary = scope.pyramid.read(column, points, start, stop)
+    return {
+        'id': colid,
+        'run': runid,
+        'steps': summary['step'],
+        'values': summary['mean'],
+        'mins': summary['min'],
+        'maxs': summary['max'],
+        'length': length,
+    }
+
+
+def is_binary(request, format):
+    if format:
+        return format == 'bin'
+    return BINARY in request.headers.get('accept', '')
+
+
+def encode_json(result):
+    return {
+        k: v.tolist() if isinstance(v, np.ndarray) else v
+        for k, v in result.items()
+    }
+
+
+def encode_binary(result):
+    # Frame layout: uint32 header size, JSON header padded to a multiple of 8
+    # bytes, then one little-endian array of the given number of rows per
+    # field listed in the header. All frames are multiples of 8 bytes so that
+    # arrays stay aligned when frames are concatenated. Other fields, such as
+    # the total length of the column, are passed through in the header.
+    arrays = {k: v for k, v in result.items() if isinstance(v, np.ndarray)}
+    header = {k: v for k, v in result.items() if k not in arrays}
+    header['rows'] = len(next(iter(arrays.values()), ()))
+    fields = [
+        (k, '<i8' if v.dtype.kind in 'iu' else '<f8')
+        for k, v in arrays.items()
+    ]
+    header['fields'] = fields
+    header = orjson.dumps(header)
+    header += b' ' * (-(4 + len(header)) % 8)
+    parts = [struct.pack('<I', len(header)), header]
+    for key, dtype in fields:
+        parts.append(np.ascontiguousarray(arrays[key], dtype).tobytes())
+    return b''.join(parts)
+
+
+def get_catalog():
+    if not runcatalog:
+        raise fastapi.HTTPException(
+            fastapi.status.HTTP_404_NOT_FOUND, detail='Catalog is disabled'
+        )
+    return runcatalog
+
+
+def parse_step_range(step_range):
+    if not step_range:
+        return None, None
+    try:
+        lo, hi = step_range.split(':')
+        return (int(lo) if lo else None), (int(hi) if hi else None)
+    except ValueError:
+        raise fastapi.HTTPException(
+            fastapi.status.HTTP_400_BAD_REQUEST,
+            detail=f'Invalid step range {step_range!r}, expected lo:hi',
+        )
+
+
+def RangeResponse(request, openfn, filesize, content_type, headers=None):
     headers = {
+        **(headers or {}),
         'content-type': content_type,
         'accept-ranges': 'bytes',
         'content-length': str(filesize),
         'access-control-expose-headers': (
             'content-type, accept-ranges, content-length, '
-            'content-range, content-encoding'
+            'content-range, content-encoding, etag'
         ),
     }
     range_header = request.headers.get('range')
@@ -173,12 +684,14 @@ def RangeResponse(request, openfn, filesize, content_type):
         status_code = fastapi.status.HTTP_200_OK
     stop = end + 1
 
-    def iterfile(chunksize=int(2e5)):
-        with openfn(start, stop) as f:
+    async def iterfile(chunksize=int(2e5)):
+        async with await openfn(start, stop) as f:
             total = stop - start
             nbytes = 0
             while nbytes < total:
-                chunk = f.read(min(chunksize, total - nbytes))
+                chunk = await f.read(min(chunksize, total - nbytes))
+                if not chunk:
+                    break
                 nbytes += len(chunk)
                 yield chunk
 
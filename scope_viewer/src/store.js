@@ -16,6 +16,161 @@ async function get(url, delay = 0) {
   return result
 }
 
+async function getBin(url) {
+  if (url.indexOf('[') >= 0)
+    throw new Error(`Invalid URL: ${url}`)
+  console.log(url)
+  const buffer = await (await fetch(url)).arrayBuffer()
+  return decodeFrame(buffer, 0)[0]
+}
+
+async function* getFrames(url, body) {
+  // Yield decoded binary frames of a streamed response as they arrive.
+  console.log(url)
+  const response = await fetch(url, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ ...body, format: 'bin' }),
+  })
+  const reader = response.body.getReader()
+  let pending = new Uint8Array(0)
+  while (true) {
+    const { done, value } = await reader.read()
+    if (value) {
+      const joined = new Uint8Array(pending.length + value.length)
+      joined.set(pending)
+      joined.set(value, pending.length)
+      pending = joined
+    }
+    let size
+    while ((size = frameSize(pending)) && size <= pending.length) {
+      // Copy the frame into its own buffer so that arrays are aligned.
+      yield decodeFrame(pending.slice(0, size).buffer, 0)[0]
+      pending = pending.subarray(size)
+    }
+    if (done)
+      break
+  }
+}
+
+function frameSize(bytes) {
+  if (bytes.length < 4)
+    return null
+  const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.length)
+  const size = view.getUint32(0, true)
+  if (bytes.length < 4 + size)
+    return null
+  const header = parseHeader(bytes.buffer, bytes.byteOffset, size)
+  return 4 + size + 8 * header.rows * header.fields.length
+}
+
+function decodeFrame(buffer, offset) {
+  // Binary frames hold a JSON header followed by little-endian arrays. Float
+  // arrays are views into the buffer and int64 steps are converted to numbers.
+  const size = new DataView(buffer, offset).getUint32(0, true)
+  const col = parseHeader(buffer, offset, size)
+  let pos = offset + 4 + size
+  for (const [key, dtype] of col.fields) {
+    if (dtype === '<f8')
+      col[key] = new Float64Array(buffer, pos, col.rows)
+    else
+      col[key] = Array.from(new BigInt64Array(buffer, pos, col.rows), Number)
+    pos += 8 * col.rows
+  }
+  delete col.fields
+  delete col.rows
+  return [col, pos]
+}
+
+function parseHeader(buffer, offset, size) {
+  const bytes = new Uint8Array(buffer, offset + 4, size)
+  return JSON.parse(new TextDecoder().decode(bytes))
+}
+
+// Float columns are downsampled on the server to roughly this many points.
+// Zooming into a chart fetches the visible window at the same resolution.
+const maxPoints = 4000
+
+// Column requests made within a short window are coalesced into batched
+// requests of at most this many columns.
+const batchSize = 200
+const batchDelay = 10
+let batchQueue = new Map()
+let batchTimer = null
+
+function getCol(colid, offset = null) {
+  if (batchQueue.has(colid))
+    return batchQueue.get(colid).promise
+  let resolve, reject
+  const promise = new Promise((res, rej) => { resolve = res; reject = rej })
+  batchQueue.set(colid, { promise, resolve, reject, offset })
+  if (!batchTimer)
+    batchTimer = setTimeout(flushCols, batchDelay)
+  return promise
+}
+
+async function flushCols() {
+  const queue = batchQueue
+  batchQueue = new Map()
+  batchTimer = null
+  const colids = [...queue.keys()]
+  for (let i = 0; i < colids.length; i += batchSize)
+    fetchCols(queue, colids.slice(i, i + batchSize))
+}
+
+async function fetchCols(queue, colids) {
+  try {
+    const offsets = Object.fromEntries(colids
+      .filter(colid => queue.get(colid).offset !== null)
+      .map(colid => [colid, queue.get(colid).offset]))
+    const body = { cols: colids, max_points: maxPoints, offsets: offsets }
+    for await (const data of getFrames('/api/cols', body)) {
+      if (data.error)
+        queue.get(data.id).reject(new Error(data.error))
+      else
+        queue.get(data.id).resolve(data)
+      queue.delete(data.id)
+    }
+  } finally {
+    colids
+      .filter(colid => queue.has(colid))
+      .map(colid => queue.get(colid).reject(new Error(`No result: ${colid}`)))
+  }
+}
+
+function deltaOffset(col) {
+  // Request only new rows of cached columns, unless appended rows have grown
+  // the column well beyond the downsampling target.
+  if (!col || col.length === undefined || col.steps.length > 2 * maxPoints)
+    return null
+  return col.length
+}
+
+function appendCol(col, delta) {
+  if (delta.offset === undefined || !col)
+    return delta
+  if (delta.length < delta.offset)
+    return { ...col, length: undefined }  // Column was replaced, fetch again.
+  if (!delta.steps.length)
+    return col
+  const { mins, maxs, ...rest } = col
+  return {
+    ...rest,
+    steps: concat(col.steps, delta.steps),
+    values: concat(col.values, delta.values),
+    length: delta.length,
+  }
+}
+
+function concat(a, b) {
+  if (!ArrayBuffer.isView(a))
+    return [...a, ...b]
+  const result = new a.constructor(a.length + b.length)
+  result.set(a)
+  result.set(b, a.length)
+  return result
+}
+
 function colToMet(col) {
   return col.substr(col.lastIndexOf(':') + 1)
 }
@@ -141,8 +296,13 @@ async function updateCols(force = false, clearOld = true) {
     .filter(colid => !pendingCols.value.has(colid))
     .filter(colid => !(colid in cachedCols.value) || force)
     .map(colid => { pendingCols.value.add(colid); return colid })
-    .map(colid => get(`/api/col/${colid}`)
-      .then(data => cachedCols.value[data.id] = shallowRef(data))
+    .map(colid => getCol(colid, deltaOffset(cachedCols.value[colid]))
+      .then(data => {
+        const col = cachedCols.value[colid]
+        const result = appendCol(col, data)
+        if (result !== col)
+          cachedCols.value[colid] = shallowRef(result)
+      })
       .finally(() => pendingCols.value.delete(colid)))
 }
 
@@ -200,7 +360,9 @@ const store = {
   pendingCols,
 
   get,
+  getBin,
   refresh,
+  maxPoints,
 
   // cachedEids,
   // cachedExps,
@@ -0,0 +1,56 @@
+import pathlib
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'scope_viewer'))
+
+import aggregate
+
+
+class TestAggregate:
+    def test_stats(self):
+        cols = [
+            (np.array([0, 10]), np.array([0.0, 10.0])),
+            (np.array([0, 10]), np.array([2.0, 12.0])),
+            (np.array([0, 10]), np.array([4.0, 14.0])),
+        ]
+        stats = aggregate.parse_stats('mean,std,min,max,median,p0,count')
+        steps, results = aggregate.aggregate(cols, stats, 3)
+        assert steps.tolist() == [0, 5, 10]
+        assert results['mean'].tolist() == [2, 7, 12]
+        assert np.allclose(results['std'], np.sqrt(8 / 3))
+        assert results['min'].tolist() == [0, 5, 10]
+        assert results['max'].tolist() == [4, 9, 14]
+        assert results['median'].tolist() == [2, 7, 12]
+        assert results['p0'].tolist() == results['min'].tolist()
+        assert results['count'].tolist() == [3, 3, 3]
+
+    def test_alignment(self):
+        # Columns with different steps are interpolated onto the same grid.
+        # Grid points outside of a column count as missing for it.
+        cols = [
+            (np.array([0, 4, 8]), np.array([0.0, 4.0, 8.0])),
+            (np.array([2, 3, 6]), np.array([12.0, 13.0, 16.0])),
+        ]
+        steps, results = aggregate.aggregate(cols, ['mean', 'count'], 5)
+        assert steps.tolist() == [0, 2, 4, 6, 8]
+        assert results['count'].tolist() == [1, 2, 2, 2, 1]
+        assert results['mean'].tolist() == [0, 7, 9, 11, 8]
+
+    def test_unsorted(self):
+        cols = [(np.array([2, 0, 1]), np.array([2.0, 0.0, 1.0]))]
+        _, results = aggregate.aggregate(cols, ['mean'], 3, 0, 2)
+        assert results['mean'].tolist() == [0, 1, 2]
+
+    def test_empty(self):
+        cols = [(np.zeros(0, np.int64), np.zeros(0))]
+        steps, results = aggregate.aggregate(cols, ['mean'], 10)
+        assert len(steps) == 0
+        assert len(results['mean']) == 0
+
+    @pytest.mark.parametrize('stat', ('foo', 'p101', 'mean,'))
+    def test_parse_invalid(self, stat):
+        with pytest.raises(ValueError):
+            aggregate.parse_stats(stat)
@@ -0,0 +1,58 @@
+import asyncio
+import pathlib
+import sys
+
+import scope
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'scope_viewer'))
+
+import catalog
+import filesystems
+
+
+class TestCatalog:
+    def test_crawl(self, tmpdir):
+        basedir = pathlib.Path(tmpdir) / 'runs'
+        logdir = basedir / 'exp' / 'run'
+        writer = scope.Writer(logdir, workers=0)
+        for step in range(10):
+            writer.add(step, {'foo': float(step), 'ns/baz': f'text {step}'})
+        writer.close()
+        # Shorter than a block, so the column has no index file yet.
+        fmts = [scope.formats.CompressedFloat(block=64)]
+        writer = scope.Writer(logdir, workers=0, formats=fmts)
+        for step in range(5):
+            writer.add(step, {'bar': float(step)})
+        writer.close()
+
+        async def find_runs(expdir):
+            return [expdir + '/run']
+
+        class Recording(filesystems.Local):
+            def size(self, path):
+                sizes.append(path)
+                return super().size(path)
+
+        sizes = []
+        index = catalog.Catalog(
+            Recording(),
+            str(basedir),
+            str(pathlib.Path(tmpdir) / 'catalog.sqlite'),
+            find_runs,
+        )
+        asyncio.run(index.crawl())
+        runs, total = index.runs()
+        assert total == 1
+        assert runs[0]['id'] == 'exp:run'
+        assert runs[0]['ncols'] == 3
+        assert runs[0]['last_step'] == 9
+        cols, _ = index.cols(run='exp:run', sort='key')
+        assert [x['key'] for x in cols] == ['bar', 'foo', 'ns/baz']
+        assert [x['length'] for x in cols] == [5, 10, 10]
+        assert [x['last_step'] for x in cols] == [4, 9, 9]
+        assert index.runs(key='ns/baz')[1] == 1
+        # Sizes come from listings, so unchanged columns are not read.
+        sizes.clear()
+        asyncio.run(index.crawl())
+        assert sizes == []
+        assert index.cols(run='exp:run')[1] == 3
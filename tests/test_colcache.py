@@ -0,0 +1,58 @@
+import asyncio
+import pathlib
+import sys
+
+import scope
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'scope_viewer'))
+
+import colcache
+import filesystems
+
+
+class Recording(filesystems.Local):
+    def __init__(self):
+        self.calls = []
+
+    def read(self, path):
+        self.calls.append(('read', 0, None))
+        return super().read(path)
+
+    def open(self, path, seek=0, limit=None):
+        self.calls.append(('open', seek, limit))
+        return super().open(path, seek, limit)
+
+
+class TestColumnCache:
+    def test_append(self, tmpdir):
+        filename = pathlib.Path(tmpdir) / 'col.float'
+        scope.table_append(filename, '>qd', range(100), range(100))
+        fs = Recording()
+        cache = colcache.ColumnCache(fs, 1e6)
+        table = asyncio.run(cache.aread(str(filename), '>i8,>f8'))
+        assert table['f0'].tolist() == list(range(100))
+        scope.table_append(filename, '>qd', range(100, 110), range(10))
+        length, table = asyncio.run(
+            cache.aread_from(str(filename), '>i8,>f8', 105)
+        )
+        assert length == 110
+        assert table['f0'].tolist() == list(range(105, 110))
+        assert fs.calls == [('read', 0, None), ('open', 1600, 1760)]
+
+    def test_offset_too_large(self, tmpdir):
+        # Columns larger than the cache are polled with ranged reads.
+        filename = pathlib.Path(tmpdir) / 'col.float'
+        scope.table_append(filename, '>qd', range(1000), range(1000))
+        fs = Recording()
+        cache = colcache.ColumnCache(fs, 1000)
+        for offset in (990, 995, 1000):
+            length, table = asyncio.run(
+                cache.aread_from(str(filename), '>i8,>f8', offset)
+            )
+            assert length == 1000
+            assert table['f0'].tolist() == list(range(offset, 1000))
+        assert fs.calls == [
+            ('open', 15840, 16000),
+            ('open', 15920, 16000),
+            ('open', 16000, 16000),
+        ]
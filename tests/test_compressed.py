@@ -0,0 +1,60 @@
+import pathlib
+
+import numpy as np
+import pytest
+
+import scope
+
+
+class TestCompressed:
+    @pytest.mark.parametrize('every', (1, 7, 100))
+    def test_roundtrip(self, tmpdir, every):
+        logdir = pathlib.Path(tmpdir)
+        fmt = scope.formats.CompressedFloat(block=32)
+        writer = scope.Writer(logdir, workers=0, formats=[fmt])
+        steps = np.arange(0, 2000, 10)
+        values = np.cumsum(np.random.default_rng(0).normal(size=len(steps)))
+        values[50] = np.nan
+        for index, (step, value) in enumerate(zip(steps, values)):
+            writer.add(step, {'foo': value})
+            if index % every == 0:
+                writer.flush()
+        writer.flush()
+        children = {x.name for x in (logdir / 'scope/foo.cfloat').glob('*')}
+        assert children == {'index', 'blocks', 'tail'}
+        size = (logdir / 'scope/foo.cfloat/blocks').stat().st_size
+        assert size < (8 + 8) * len(steps)
+        reader = scope.Reader(logdir)
+        assert reader.keys() == ('foo',)
+        assert reader.length('foo') == len(steps)
+        actual_steps, actual_values = reader['foo']
+        assert actual_steps.dtype == np.int64
+        assert (actual_steps == steps).all()
+        assert np.array_equal(actual_values, values, equal_nan=True)
+        for start, stop in [
+            (0, 1),
+            (5, 40),
+            (31, 33),
+            (150, 200),
+            (199, None),
+        ]:
+            actual_steps, actual_values = reader.read('foo', start, stop)
+            assert (actual_steps == steps[start:stop]).all()
+            assert np.array_equal(
+                actual_values, values[start:stop], equal_nan=True
+            )
+        for lo, hi in [(0, 10), (15, 325), (1000, 1990), (1990, None)]:
+            actual_steps, _ = reader.read_steps('foo', lo, hi)
+            mask = (steps >= lo) & (steps < (hi or np.inf))
+            assert (actual_steps == steps[mask]).all()
+
+    def test_codec(self):
+        steps = np.arange(100, 5000, 7)
+        values = np.sin(steps / 100)
+        buffer = scope.formats.compressed_encode(steps, values)
+        assert len(buffer) < (8 + 8) * len(steps) / 2
+        actual_steps, actual_values = scope.formats.compressed_decode(
+            buffer, len(steps)
+        )
+        assert (actual_steps == steps).all()
+        assert (actual_values == values).all()
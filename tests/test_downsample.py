@@ -0,0 +1,83 @@
+import pathlib
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'scope_viewer'))
+
+import downsample
+
+
+class TestDownsample:
+    def test_minmax_envelope(self):
+        steps = np.arange(100)
+        values = np.sin(steps / 5)
+        indices = downsample.minmax(steps, values, 10)
+        assert indices[0] == 0
+        assert indices[-1] == 99
+        assert (np.diff(indices) > 0).all()
+        assert len(indices) <= 10 + 2
+        # Every bucket of 20 rows keeps its minimum and maximum.
+        for start in range(0, 100, 20):
+            bucket = values[start : start + 20]
+            selected = [i for i in indices if start <= i < start + 20]
+            assert values[selected].min() == bucket.min()
+            assert values[selected].max() == bucket.max()
+
+    def test_minmax_uneven(self):
+        # The last bucket is shorter when the rows do not divide evenly.
+        steps = np.arange(101)
+        values = steps.astype(np.float64)
+        indices = downsample.minmax(steps, values, 10)
+        assert indices.tolist() == [0, 20, 21, 41, 42, 62, 63, 83, 84, 100]
+
+    def test_minmax_nan(self):
+        steps = np.arange(100)
+        values = np.sin(steps / 5)
+        values[10:30] = np.nan
+        indices = downsample.minmax(steps, values, 10)
+        assert indices[0] == 0 and indices[-1] == 99
+        assert not np.isnan(values[indices]).any()
+        values[:] = np.nan
+        indices = downsample.minmax(steps, values, 10)
+        assert indices.tolist() == [0, 20, 40, 60, 80, 99]
+
+    def test_lttb(self):
+        steps = np.arange(1000)
+        values = np.zeros(1000)
+        values[500] = 10
+        indices = downsample.lttb(steps, values, 20)
+        assert indices[0] == 0
+        assert indices[-1] == 999
+        assert len(indices) <= 20
+        assert (np.diff(indices) > 0).all()
+        assert 500 in indices
+
+    def test_lttb_nan(self):
+        steps = np.arange(100)
+        values = np.sin(steps / 5)
+        values[10:30] = np.nan
+        indices = downsample.lttb(steps, values, 10)
+        assert indices[0] == 0 and indices[-1] == 99
+        assert (np.diff(indices) > 0).all()
+
+    @pytest.mark.parametrize('method', ('minmax', 'lttb'))
+    @pytest.mark.parametrize('points', (100, 101, None))
+    def test_enough_points(self, method, points):
+        steps = np.arange(100)
+        values = np.cos(steps)
+        result = downsample.downsample(steps, values, points, method)
+        assert result[0] is steps
+        assert result[1] is values
+
+    def test_step_range(self):
+        steps = np.array([0, 1, 2, 3, 4, 2, 3])
+        values = steps * 10.0
+        result = downsample.step_range(steps, values, 2, 3)
+        assert result[0].tolist() == [2, 3, 2, 3]
+        assert result[1].tolist() == [20.0, 30.0, 20.0, 30.0]
+        assert downsample.step_range(steps, values, 4)[0].tolist() == [4]
+        assert downsample.step_range(steps, values, hi=0)[0].tolist() == [0]
+        result = downsample.step_range(steps, values)
+        assert result[0].tolist() == steps.tolist()
@@ -0,0 +1,128 @@
+import asyncio
+import pathlib
+import sqlite3
+import sys
+
+import scope
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'scope_viewer'))
+
+import filesystems
+
+
+class TestFileCache:
+    def test_roundtrip(self, tmpdir):
+        source = pathlib.Path(tmpdir) / 'source'
+        source.write_bytes(b'hello world')
+        fs = filesystems.WithFileCache(
+            filesystems.Elements(), pathlib.Path(tmpdir) / 'cache', 1e6
+        )
+        assert fs.read(str(source)) == b'hello world'
+        source.write_bytes(b'changed')
+        assert asyncio.run(fs.aread(str(source))) == b'hello world'
+
+    def test_touch(self, tmpdir):
+        # Hits update the access time at most once per touch interval.
+        source = pathlib.Path(tmpdir) / 'source'
+        source.write_bytes(b'hello')
+        cachedir = pathlib.Path(tmpdir) / 'cache'
+        fs = filesystems.WithFileCache(filesystems.Elements(), cachedir, 1e6)
+        index = sqlite3.connect(cachedir / '.index.sqlite')
+        query = 'SELECT atime FROM files'
+        fs.read(str(source))
+        fs.read(str(source))
+        (before,) = index.execute(query).fetchone()
+        fs.read(str(source))
+        assert index.execute(query).fetchone() == (before,)
+        fs.touch = 0
+        fs.read(str(source))
+        assert index.execute(query).fetchone() > (before,)
+
+    def test_derive_single_stripe(self, tmpdir):
+        # Producing a derived asset reads the source through the cache. With
+        # a single stripe, both share the same file lock.
+        source = pathlib.Path(tmpdir) / 'source'
+        source.write_bytes(b'hello')
+        fs = filesystems.WithFileCache(
+            filesystems.Elements(),
+            pathlib.Path(tmpdir) / 'cache',
+            1e6,
+            stripes=1,
+        )
+
+        async def produce():
+            return (await fs.aread(str(source))).upper()
+
+        async def run():
+            derive = fs.aderive(f'{source}@thumb', produce)
+            return await asyncio.wait_for(derive, 10)
+
+        assert asyncio.run(run()) == b'HELLO'
+        assert asyncio.run(run()) == b'HELLO'
+
+    def test_concurrent_misses(self, tmpdir):
+        # More concurrent misses than storage calls the cache runs at once.
+        # Waiting for a file lock must not hold one of them.
+        sources = [pathlib.Path(tmpdir) / f'source{i}' for i in range(64)]
+        for i, source in enumerate(sources):
+            source.write_bytes(f'value {i}'.encode())
+        fs = filesystems.WithFileCache(
+            filesystems.Elements(),
+            pathlib.Path(tmpdir) / 'cache',
+            1e6,
+            stripes=4,
+        )
+        fs.limit = 8
+
+        async def run():
+            reads = asyncio.gather(*[fs.aread(str(x)) for x in sources])
+            return await asyncio.wait_for(reads, 10)
+
+        buffers = asyncio.run(run())
+        assert buffers == [f'value {i}'.encode() for i in range(64)]
+
+
+class TestFsPath:
+    def test_range_reads(self, tmpdir):
+        # Bisecting a column reads only the probed rows rather than the whole
+        # file, which matters for filesystems that download on open.
+        filename = pathlib.Path(tmpdir) / 'col.float'
+        scope.table_append(filename, '>qd', range(1000), range(1000))
+
+        class Recording(filesystems.Elements):
+            def open(self, path, seek=0, limit=None):
+                ranges.append((seek, limit))
+                return super().open(path, seek, limit)
+
+        ranges = []
+        path = filesystems.FsPath(Recording(), str(filename))
+        assert scope.formats.table_bisect(path, '>qd', 500) == 500
+        assert 0 < len(ranges) <= 11
+        assert all(limit - seek == 8 for seek, limit in ranges)
+        ranges.clear()
+        steps, _ = scope.table_read(path, '>qd', 10, 20)
+        assert steps.tolist() == list(range(10, 20))
+        assert ranges == [(160, 320)]
+
+
+class TestListCache:
+    def test_shared_invalidation(self, tmpdir):
+        # Two caches with the same log file stand in for two server workers.
+        folder = pathlib.Path(tmpdir) / 'runs'
+        (folder / 'a').mkdir(parents=True)
+        logfile = pathlib.Path(tmpdir) / 'listcache.log'
+        first = filesystems.WithListCache(filesystems.Local(), logfile=logfile)
+        second = filesystems.WithListCache(
+            filesystems.Local(), logfile=logfile
+        )
+        assert len(first.list(str(folder))) == 1
+        assert len(second.list(str(folder))) == 1
+        (folder / 'b').mkdir()
+        assert len(second.list(str(folder))) == 1
+        first.invalidate(str(folder))
+        assert len(second.list(str(folder))) == 2
+        (folder / 'c').mkdir()
+        second.maxlog = 0
+        second.invalidate(str(folder / 'other'))
+        # The log was truncated, so the first cache drops all listings.
+        assert len(first.list(str(folder))) == 3
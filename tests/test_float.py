@@ -1,8 +1,9 @@
 import pathlib
 
-import scope
 import numpy as np
 
+import scope
+
 
 class TestFloat:
     def test_roundtrip(self, tmpdir):
@@ -28,7 +29,7 @@ class TestFloat:
         for step in range(10):
             writer.add(step, {'foo': step, 'bar': step})
         writer.flush()
-        writer.flush()  # Block until previous flush is done.
+        writer.wait()
         filenames = (logdir / 'scope').glob('*')
         assert {x.name for x in filenames} == {'foo.float', 'bar.float'}
         assert (logdir / 'scope/foo.float').stat().st_size == (8 + 8) * 10
@@ -49,6 +50,87 @@ class TestFloat:
         assert reader.length('foo/bar') == 1
         assert equal(reader['foo/bar'], ([0], [12]), (np.int64, np.float64))
 
+    def test_mmap(self, tmpdir):
+        logdir = pathlib.Path(tmpdir)
+        writer = scope.Writer(logdir, workers=0)
+        for step in range(10):
+            writer.add(step, {'foo': step / 2})
+        writer.flush()
+        reader = scope.Reader(logdir, mmap=True)
+        steps, values = reader['foo']
+        assert isinstance(steps, np.memmap)
+        assert isinstance(values, np.memmap)
+        assert equal((steps, values), (np.arange(10), np.arange(10) / 2))
+
+    def test_ranges(self, tmpdir):
+        logdir = pathlib.Path(tmpdir)
+        writer = scope.Writer(logdir, workers=0)
+        for step in range(0, 100, 10):
+            writer.add(step, {'foo': step, 'bar': 'text'})
+        writer.flush()
+        reader = scope.Reader(logdir)
+        steps, values = reader.read('foo', 2, 5)
+        assert equal((steps, values), ([20, 30, 40], [20, 30, 40]))
+        steps, values = reader.read('foo', -3)
+        assert equal((steps, values), ([70, 80, 90], [70, 80, 90]))
+        assert len(reader.read('foo', 5, 5)[0]) == 0
+        steps, values = reader.read_steps('foo', 25, 60)
+        assert equal((steps, values), ([30, 40, 50], [30, 40, 50]))
+        steps, values = reader.read_steps('foo', 85)
+        assert equal((steps, values), ([90], [90]))
+        assert len(reader.read_steps('foo', 41, 45)[0]) == 0
+        steps, filenames = reader.read_steps('bar', 10, 30)
+        assert (steps == [10, 20]).all()
+        assert [reader.load('bar', x) for x in filenames] == ['text'] * 2
+
+    def test_poll(self, tmpdir):
+        logdir = pathlib.Path(tmpdir)
+        writer = scope.Writer(logdir, workers=0)
+        writer.add(0, {'foo': 1})
+        writer.add(1, {'foo': 2})
+        writer.flush()
+        reader = scope.Reader(logdir)
+        results = reader.poll()
+        assert list(results.keys()) == ['foo']
+        assert equal(results['foo'], ([0, 1], [1, 2]))
+        assert reader.poll() == {}
+        writer.add(2, {'foo': 3, 'bar': 4})
+        writer.flush()
+        results = reader.poll()
+        assert reader.keys() == ('bar', 'foo')
+        assert equal(results['foo'], ([2], [3]))
+        assert equal(results['bar'], ([2], [4]))
+        assert reader.poll() == {}
+
+    def test_table(self, tmpdir):
+        filename = pathlib.Path(tmpdir) / 'table'
+        idents = [bytes([i]) * 4 + bytes(4) for i in range(5)]
+        scope.table_append(filename, 'q8s', range(5), idents)
+        steps, result = scope.table_read(filename, 'q8s')
+        assert (steps == np.arange(5)).all()
+        assert result.tolist() == idents
+        steps, result = scope.table_read(filename, 'q8s', 1, 3)
+        assert (steps == np.arange(1, 3)).all()
+        assert result.tolist() == idents[1:3]
+        with filename.open('ab') as f:
+            f.write(bytes(7))  # Partially written row.
+        steps, _ = scope.table_read(filename, 'q8s')
+        assert (steps == np.arange(5)).all()
+
+    def test_read_many(self, tmpdir):
+        logdir = pathlib.Path(tmpdir)
+        writer = scope.Writer(logdir, workers=0)
+        keys = [f'key{i}' for i in range(10)]
+        for step in range(5):
+            writer.add(step, {k: i * step for i, k in enumerate(keys)})
+        writer.flush()
+        reader = scope.Reader(logdir)
+        results = list(reader.read_many(keys, workers=4, prefetch=2))
+        assert len(results) == len(keys)
+        for i, (steps, values) in enumerate(results):
+            assert steps.tolist() == list(range(5))
+            assert values.tolist() == [i * x for x in range(5)]
+
 
 def equal(actuals, references, dtypes=None):
     dtypes = dtypes or [x.dtype for x in actuals]
@@ -1,7 +1,9 @@
 import pathlib
 
-import scope
 import numpy as np
+import pytest
+
+import scope
 
 
 class TestImage:
@@ -31,7 +33,7 @@ class TestImage:
             for key in ('foo', 'bar', 'baz'):
                 writer.add(step, {key: np.full((64, 128, 3), step, np.uint8)})
         writer.flush()
-        writer.flush()  # Block until previous flush is done.
+        writer.wait()
         assert {x.name for x in (logdir / 'scope').glob('*')} == {
             'foo.png',
             'bar.png',
@@ -69,3 +71,150 @@ class TestImage:
         _, filenames = reader['foo/bar']
         assert len(filenames) == 1
         assert (reader.load('foo/bar', filenames[0]) == img).all()
+
+    def test_process_encoder(self, tmpdir):
+        logdir = pathlib.Path(tmpdir)
+        writer = scope.Writer(logdir, workers=2, encoder='process')
+        for step in range(5):
+            img = np.full((64, 128, 3), step, np.uint8)
+            writer.add(step, {'foo': img, 'bar': 'text', 'baz': step})
+        writer.flush()
+        writer.wait()
+        reader = scope.Reader(logdir)
+        assert reader.keys() == ('bar', 'baz', 'foo')
+        steps, filenames = reader['foo']
+        values = [reader.load('foo', x) for x in filenames]
+        assert (steps == np.arange(5)).all()
+        reference = np.arange(5, dtype=np.uint8)[:, None, None, None]
+        assert (np.array(values) == reference).all()
+        _, filenames = reader['bar']
+        assert [reader.load('bar', x) for x in filenames] == ['text'] * 5
+        assert writer.stats()['columns']['foo.png']['encode']['count'] >= 1
+
+    def test_process_encoder_text(self, tmpdir):
+        # Strings are encoded in the writer thread, not in the processes.
+        logdir = pathlib.Path(tmpdir)
+        writer = scope.Writer(logdir, workers=0, encoder='process')
+        submitted = []
+        submit = writer.procs.submit
+        writer.procs.submit = lambda *a: submitted.append(a) or submit(*a)
+        img = np.full((64, 128, 3), 7, np.uint8)
+        writer.add(0, {'foo': img, 'bar': 'text'})
+        writer.close()
+        assert len(submitted) == 1
+        reader = scope.Reader(logdir)
+        _, filenames = reader['bar']
+        assert reader.load('bar', filenames[0]) == 'text'
+        _, filenames = reader['foo']
+        assert (reader.load('foo', filenames[0]) == img).all()
+
+    def test_packed(self, tmpdir):
+        logdir = pathlib.Path(tmpdir)
+        fmts = [
+            scope.formats.Text(packed=True),
+            scope.formats.Image(packed=True),
+        ]
+        writer = scope.Writer(logdir, workers=0, formats=fmts)
+        for step in range(6):
+            img = np.full((64, 128, 3), step, np.uint8)
+            writer.add(step, {'foo': img, 'bar': f'text {step}'})
+            if step % 3 == 2:
+                writer.flush()
+        children = {x.name for x in (logdir / 'scope/foo.png').glob('*')}
+        assert len(children) == 1 + 2
+        assert 'shards' in children
+        reader = scope.Reader(logdir)
+        assert reader.length('foo') == 6
+        steps, filenames = reader['foo']
+        values = [reader.load('foo', x) for x in filenames]
+        assert (steps == np.arange(6)).all()
+        reference = np.arange(6, dtype=np.uint8)[:, None, None, None]
+        assert (np.array(values) == reference).all()
+        steps, filenames = reader.read_steps('bar', 2, 4)
+        assert (steps == [2, 3]).all()
+        assert [reader.load('bar', x) for x in filenames] == [
+            'text 2',
+            'text 3',
+        ]
+
+    def test_negative_steps(self, tmpdir):
+        logdir = pathlib.Path(tmpdir)
+        fmts = [scope.formats.Text(), scope.formats.Image(packed=True)]
+        writer = scope.Writer(logdir, workers=0, formats=fmts)
+        for step in (-5, 3):
+            img = np.full((8, 8, 3), step % 256, np.uint8)
+            writer.add(step, {'foo': img, 'bar': f'text {step}'})
+        writer.flush()
+        reader = scope.Reader(logdir)
+        steps, filenames = reader['bar']
+        assert steps.tolist() == [-5, 3]
+        assert [reader.load('bar', x) for x in filenames] == [
+            'text -5',
+            'text 3',
+        ]
+        steps, filenames = reader['foo']
+        assert steps.tolist() == [-5, 3]
+        values = [reader.load('foo', x)[0, 0, 0] for x in filenames]
+        assert values == [251, 3]
+
+    def test_packed_existing(self, tmpdir):
+        logdir = pathlib.Path(tmpdir)
+        writer = scope.Writer(logdir, workers=0)
+        writer.add(0, {'foo': 'before'})
+        writer.flush()
+        fmts = [scope.formats.Text(packed=True)]
+        writer = scope.Writer(logdir, workers=0, formats=fmts)
+        writer.add(1, {'foo': 'after'})
+        writer.flush()
+        reader = scope.Reader(logdir)
+        _, filenames = reader['foo']
+        assert [reader.load('foo', x) for x in filenames] == [
+            'before',
+            'after',
+        ]
+
+    def test_unpacked_existing(self, tmpdir):
+        logdir = pathlib.Path(tmpdir)
+        fmts = [scope.formats.Text(packed=True)]
+        writer = scope.Writer(logdir, workers=0, formats=fmts)
+        writer.add(0, {'foo': 'before'})
+        writer.flush()
+        writer = scope.Writer(logdir, workers=0)
+        writer.add(1, {'foo': 'after'})
+        writer.flush()
+        children = {x.name for x in (logdir / 'scope/foo.txt').glob('*')}
+        assert 'index' not in children
+        reader = scope.Reader(logdir)
+        steps, filenames = reader['foo']
+        assert steps.tolist() == [0, 1]
+        assert [reader.load('foo', x) for x in filenames] == [
+            'before',
+            'after',
+        ]
+
+    def test_load_many(self, tmpdir):
+        logdir = pathlib.Path(tmpdir)
+        writer = scope.Writer(logdir, workers=0)
+        for step in range(20):
+            writer.add(step, {'foo': np.full((16, 32, 3), step, np.uint8)})
+        writer.add(20, {'bar': np.zeros((16, 32, 3), np.uint8)})
+        writer.add(21, {'bar': np.zeros((8, 32, 3), np.uint8)})
+        writer.flush()
+        reader = scope.Reader(logdir)
+        _, filenames = reader['foo']
+        values = list(reader.load_many('foo', filenames, workers=4))
+        reference = np.arange(20, dtype=np.uint8)[:, None, None, None]
+        assert (np.array(values) == reference).all()
+        values = reader.load_many('foo', filenames, workers=2, prefetch=3)
+        assert next(values)[0, 0, 0] == 0
+        assert next(values)[0, 0, 0] == 1
+        values.close()
+        array = reader.load_many('foo', filenames, workers=4, stack=True)
+        assert array.shape == (20, 16, 32, 3)
+        assert array.dtype == np.uint8
+        assert (array == reference).all()
+        array = reader.load_many('foo', filenames, workers=0, stack=True)
+        assert (array == reference).all()
+        _, filenames = reader['bar']
+        with pytest.raises(ValueError):
+            reader.load_many('bar', filenames, stack=True)
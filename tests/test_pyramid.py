@@ -0,0 +1,55 @@
+import pathlib
+
+import numpy as np
+
+import scope
+
+
+class TestPyramid:
+    def test_incremental(self, tmpdir):
+        logdir = pathlib.Path(tmpdir)
+        fmt = scope.formats.Float(pyramid=True)
+        writer = scope.Writer(logdir, workers=0, formats=[fmt])
+        values = np.random.default_rng(0).normal(size=5000)
+        values[100:140] = np.nan
+        for step, value in enumerate(values):
+            writer.add(step, {'foo': value})
+            if step % 37 == 0:
+                writer.flush()
+        writer.flush()
+        assert {x.name for x in (logdir / 'scope').glob('*')} == {
+            'foo.float',
+            '.pyramid',
+        }
+        reader = scope.Reader(logdir)
+        assert reader.keys() == ('foo',)
+        for lo, hi in [(None, None), (123, 4567), (17, 40), (90, 150)]:
+            summary = reader.summary('foo', 20, lo, hi)
+            steps = np.arange(lo or 0, hi or len(values))
+            assert summary['step'][0] == steps[0]
+            assert summary['last_step'][-1] == steps[-1]
+            assert summary['count'].sum() == (~np.isnan(values[steps])).sum()
+            assert np.nanmin(summary['min']) == np.nanmin(values[steps])
+            assert np.nanmax(summary['max']) == np.nanmax(values[steps])
+            assert len(summary['step']) == 20
+            assert (np.diff(summary['step']) > 0).all()
+
+    def test_rebuild(self, tmpdir):
+        logdir = pathlib.Path(tmpdir)
+        writer = scope.Writer(logdir, workers=0)
+        for step in range(1000):
+            writer.add(step, {'foo': step})
+        writer.flush()
+        reader = scope.Reader(logdir)
+        expected = reader.summary('foo', 10)
+        assert len(expected['step']) == 10
+        scope.pyramid.main([logdir])
+        assert (logdir / 'scope/.pyramid/foo.float/0').exists()
+        summary = reader.summary('foo', 10)
+        assert summary['count'].sum() == 1000
+        total = (summary['mean'] * summary['count']).sum()
+        assert total == np.arange(1000).sum()
+        levels = scope.pyramid.folder(logdir / 'scope/foo.float')
+        level0 = scope.table_read(levels / '0', scope.pyramid.FMT)
+        assert (level0[0] == np.arange(0, 992, 16)).all()
+        assert (level0[5] == np.arange(0, 992, 16) + 7.5).all()
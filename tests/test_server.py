@@ -0,0 +1,268 @@
+import io
+import json
+import struct
+import sys
+
+import numpy as np
+import PIL.Image
+import pytest
+
+import scope
+
+
+@pytest.fixture(scope='module')
+def client(tmp_path_factory):
+    basedir = tmp_path_factory.mktemp('runs')
+    writer = scope.Writer(basedir / 'exp' / 'run', workers=0)
+    for step in range(100):
+        writer.add(step, {'foo': float(step), 'baz': f'text {step}'})
+    writer.add(-5, {'neg': 'negative'})
+    writer.close()
+    fmts = [scope.formats.CompressedFloat(block=64)]
+    writer = scope.Writer(basedir / 'exp' / 'run', workers=0, formats=fmts)
+    for step in range(30):
+        writer.add(step, {'bar': float(step)})
+    writer.close()
+    fmts = [scope.formats.Text(packed=True)]
+    writer = scope.Writer(basedir / 'exp' / 'run', workers=0, formats=fmts)
+    for step in (-3, 4):
+        writer.add(step, {'pak': f'packed {step}'})
+    writer.close()
+    writer = scope.Writer(basedir / 'exp' / 'run2', workers=0)
+    for step in range(0, 100, 2):
+        writer.add(step, {'foo': float(step + 10)})
+    writer.close()
+    writer = scope.Writer(basedir / 'exp' / 'media', workers=0)
+    image = np.zeros((60, 120, 3), np.uint8)
+    image[:, 60:] = 255
+    writer.add(0, {'img': image, 'vid': np.stack([image] * 5)})
+    writer.close()
+    fmts = [scope.formats.Float(pyramid=True)]
+    writer = scope.Writer(basedir / 'exp' / 'pyr', workers=0, formats=fmts)
+    for step in range(5000):
+        writer.add(step, {'foo': float(step % 100)})
+    writer.close()
+    argv = sys.argv
+    sys.argv = [
+        'server',
+        '--basedir',
+        str(basedir),
+        '--filesystem',
+        'local',
+        '--catalog',
+        '',
+        '--cachedir',
+        str(tmp_path_factory.mktemp('cache')),
+        '--servertiming',
+        'True',
+    ]
+    try:
+        from fastapi.testclient import TestClient
+
+        from scope_viewer import server
+    finally:
+        sys.argv = argv
+    server.basedir = str(basedir)
+    return TestClient(server.app)
+
+
+class TestServer:
+    def test_float(self, client):
+        response = client.get('/api/col/exp:run:scope:foo.float')
+        assert response.status_code == 200
+        result = response.json()
+        assert result['steps'] == list(range(100))
+        assert result['values'] == [float(x) for x in range(100)]
+
+    def test_compressed(self, client):
+        # The column is shorter than a block, so it has no index yet.
+        response = client.get('/api/col/exp:run:scope:bar.cfloat')
+        assert response.status_code == 200
+        result = response.json()
+        assert result['steps'] == list(range(30))
+        assert result['values'] == [float(x) for x in range(30)]
+
+    def test_text(self, client):
+        response = client.get('/api/col/exp:run:scope:baz.txt')
+        assert response.status_code == 200
+        result = response.json()
+        assert result['steps'] == list(range(100))
+        assert len(result['values']) == 100
+
+    def test_file(self, client):
+        response = client.get('/api/col/exp:run:scope:neg.txt')
+        (fileid,) = response.json()['values']
+        response = client.get(f'/api/file/{fileid}')
+        assert response.status_code == 200
+        assert response.json()['text'] == 'negative'
+
+    def test_file_packed(self, client):
+        response = client.get('/api/col/exp:run:scope:pak.txt')
+        result = response.json()
+        assert result['steps'] == [-3, 4]
+        texts = []
+        for fileid in result['values']:
+            response = client.get(f'/api/file/{fileid}')
+            texts.append(response.json()['text'])
+        assert texts == ['packed -3', 'packed 4']
+
+    def test_thumbnail(self, client):
+        response = client.get('/api/col/exp:media:scope:img.png')
+        (fileid,) = response.json()['values']
+        for params, size in (
+            ({'w': 30}, (30, 15)),
+            ({'h': 20}, (40, 20)),
+            ({'w': 30, 'h': 5}, (10, 5)),
+            ({'w': 1000}, (120, 60)),
+        ):
+            response = client.get(f'/api/file/{fileid}', params=params)
+            assert response.headers['content-type'] == 'image/png'
+            image = PIL.Image.open(io.BytesIO(response.content))
+            assert image.format == 'PNG'
+            assert image.size == size
+        # The left half stays black and the right half white.
+        image = np.asarray(image.convert('L'))
+        assert image[:, :50].max() < 10 and image[:, 70:].min() > 245
+
+    def test_poster(self, client):
+        response = client.get('/api/col/exp:media:scope:vid.mp4')
+        (fileid,) = response.json()['values']
+        params = {'poster': True, 'w': 60}
+        response = client.get(f'/api/file/{fileid}', params=params)
+        assert response.headers['content-type'] == 'image/jpeg'
+        image = PIL.Image.open(io.BytesIO(response.content))
+        assert image.format == 'JPEG'
+        assert getattr(image, 'n_frames', 1) == 1
+        assert image.size == (60, 30)
+        image = np.asarray(image.convert('L'))
+        assert image[:, :25].max() < 30 and image[:, 35:].min() > 225
+
+    def test_not_modified(self, client):
+        for colid in ('foo.float', 'bar.cfloat', 'baz.txt'):
+            url = f'/api/col/exp:run:scope:{colid}'
+            response = client.get(url)
+            etag = response.headers['etag']
+            response = client.get(url, headers={'if-none-match': etag})
+            assert response.status_code == 304
+            response = client.get(url + '?max_points=10')
+            assert response.headers['etag'] != etag
+
+    def test_pyramid(self, client, monkeypatch):
+        from scope_viewer import server
+
+        checks = []
+        aexists = server.fs.aexists
+        monkeypatch.setattr(
+            server.fs, 'aexists', lambda x: checks.append(x) or aexists(x)
+        )
+        url = '/api/col/exp:pyr:scope:foo.float'
+        for _ in range(2):
+            result = client.get(url, params={'max_points': 100}).json()
+            assert len(result['steps']) == 100
+            assert result['steps'][0] == 0
+            assert min(result['mins']) == 0 and max(result['maxs']) == 99
+        # Whether the pyramid exists is cached with the column version.
+        assert len(checks) == 1
+        params = {'max_points': 100, 'method': 'lttb'}
+        result = client.get(url, params=params).json()
+        assert 'mins' not in result
+        assert len(result['steps']) == 100
+        assert result['steps'][0] == 0 and result['steps'][-1] == 4999
+
+    def test_binary_offset(self, client):
+        colid = 'exp:run:scope:foo.float'
+        response = client.get(f'/api/col/{colid}?format=bin&offset=90')
+        (header, arrays), *rest = decode(response.content)
+        assert not rest
+        assert header['length'] == 100
+        assert header['offset'] == 90
+        assert header['rows'] == 10
+        assert arrays['steps'].tolist() == list(range(90, 100))
+        body = {
+            'cols': [colid, 'exp:run:scope:bar.cfloat'],
+            'format': 'bin',
+            'offsets': {colid: 95},
+        }
+        response = client.post('/api/cols', json=body)
+        frames = {x['id']: (x, y) for x, y in decode(response.content)}
+        header, arrays = frames[colid]
+        assert (header['length'], header['offset'], header['rows']) == (
+            100,
+            95,
+            5,
+        )
+        assert arrays['values'].tolist() == [95.0, 96.0, 97.0, 98.0, 99.0]
+        header, arrays = frames['exp:run:scope:bar.cfloat']
+        assert 'offset' not in header
+        assert header['length'] == header['rows'] == 30
+
+    def test_agg(self, client):
+        cols = 'exp:run:scope:foo.float,exp:run2:scope:foo.float'
+        params = {'cols': cols, 'stat': 'mean,std,min,max,count', 'grid': 3}
+        response = client.get('/api/agg', params=params)
+        assert response.status_code == 200
+        result = response.json()
+        assert result['steps'] == [0, 49.5, 99]
+        # The second run ends at step 98, so the last grid point only has the
+        # first run.
+        assert result['count'] == [2, 2, 1]
+        assert result['mean'] == [5, 54.5, 99]
+        assert result['std'] == [5, 5, 0]
+        assert result['min'] == [0, 49.5, 99]
+        assert result['max'] == [10, 59.5, 99]
+        params['step_range'] = '10:20'
+        result = client.get('/api/agg', params=params).json()
+        assert result['steps'] == [10, 15, 20]
+        assert result['mean'] == [15, 20, 25]
+
+    def test_agg_binary(self, client):
+        cols = 'exp:run:scope:foo.float,exp:run:scope:bar.cfloat'
+        params = {'cols': cols, 'stat': 'mean,count', 'grid': 4}
+        params['format'] = 'bin'
+        response = client.get('/api/agg', params=params)
+        ((header, arrays),) = decode(response.content)
+        assert header['rows'] == 4
+        assert arrays['steps'].tolist() == [0, 33, 66, 99]
+        assert arrays['count'].tolist() == [2, 1, 1, 1]
+        assert arrays['mean'].tolist() == [0, 33, 66, 99]
+
+    def test_agg_errors(self, client):
+        cols = 'exp:run:scope:foo.float,exp:missing:scope:foo.float'
+        response = client.get('/api/agg', params={'cols': cols})
+        assert response.status_code == 404
+        assert 'exp:missing:scope:foo.float' in response.json()['detail']
+        params = {'cols': 'exp:run:scope:baz.txt'}
+        response = client.get('/api/agg', params=params)
+        assert response.status_code == 400
+        params = {'cols': 'exp:run:scope:foo.float', 'stat': 'foo'}
+        response = client.get('/api/agg', params=params)
+        assert response.status_code == 400
+
+    def test_metrics(self, client):
+        url = '/api/col/exp:run2:scope:foo.float'
+        response = client.get(url)
+        timing = response.headers['server-timing']
+        assert 'storage;dur=' in timing
+        assert 'total;dur=' in timing
+        client.get(url)
+        text = client.get('/metrics').text
+        labels = 'endpoint="/api/col/{colid}",method="GET",status="200"'
+        assert f'scope_request_seconds_count{{{labels}}}' in text
+        assert f'scope_request_seconds_bucket{{{labels},le="+Inf"}}' in text
+        assert 'scope_cache_total{cache="column",result="miss"}' in text
+        assert 'scope_cache_total{cache="column",result="hit"}' in text
+        assert 'scope_storage_seconds_count{backend="Local",op="size"}' in text
+
+
+def decode(buffer):
+    frames = []
+    while buffer:
+        (size,) = struct.unpack('<I', buffer[:4])
+        header = json.loads(buffer[4 : 4 + size])
+        pos, arrays = 4 + size, {}
+        for key, dtype in header['fields']:
+            arrays[key] = np.frombuffer(buffer, dtype, header['rows'], pos)
+            pos += 8 * header['rows']
+        frames.append((header, arrays))
+        buffer = buffer[pos:]
+    return frames
@@ -2,6 +2,7 @@ import pathlib
 
 import numpy as np
 import pytest
+
 import scope
 
 
@@ -32,3 +33,36 @@ class TestVideo:
         values = [reader.load('foo', x) for x in filenames]
         assert all(x.dtype == np.uint8 for x in values)
         assert np.allclose(values, [vid1, vid2], rtol=0.1, atol=3)
+
+    @pytest.mark.parametrize('workers', (0, 4))
+    def test_streaming(self, tmpdir, workers):
+        logdir = pathlib.Path(tmpdir)
+        writer = scope.Writer(logdir, workers=workers)
+        vid1 = np.ones((6, 64, 128, 3), np.uint8) + 12
+        vid2 = np.ones((3, 64, 128, 3), np.uint8) + 200
+        for chunk in np.split(vid1, 3):
+            writer.add_frames(0, 'foo', chunk)
+        writer.end_video(0, 'foo')
+        writer.add(5, {'foo': vid2})
+        writer.flush()
+        writer.close()
+        reader = scope.Reader(logdir)
+        assert reader.keys() == ('foo',)
+        steps, filenames = reader['foo']
+        assert steps.tolist() == [0, 5]
+        assert reader.read_steps('foo', 0, 3)[0].tolist() == [0]
+        values = {s: reader.load('foo', x) for s, x in zip(steps, filenames)}
+        assert np.allclose(values[0], vid1, rtol=0.1, atol=3)
+        assert np.allclose(values[5], vid2, rtol=0.1, atol=3)
+
+    def test_streaming_close(self, tmpdir):
+        logdir = pathlib.Path(tmpdir)
+        writer = scope.Writer(logdir, workers=2)
+        vid = np.ones((4, 64, 128, 3), np.uint8) + 12
+        writer.add_frames(2, 'foo', vid[:2])
+        writer.add_frames(3, 'foo', vid[2:])
+        writer.close()
+        steps, filenames = scope.Reader(logdir)['foo']
+        assert steps.tolist() == [3]
+        value = scope.Reader(logdir).load('foo', filenames[0])
+        assert np.allclose(value, vid, rtol=0.1, atol=3)
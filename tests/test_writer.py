@@ -0,0 +1,154 @@
+import gc
+import pathlib
+import time
+import weakref
+
+import numpy as np
+import pytest
+
+import scope
+
+
+class SlowFloat(scope.formats.Float):
+    def write(self, path, steps, values):
+        time.sleep(0.2)
+        super().write(path, steps, values)
+
+
+class SlowText(scope.formats.Text):
+    def write(self, path, steps, values):
+        time.sleep(0.2)
+        super().write(path, steps, values)
+
+
+class Failing(scope.formats.Float):
+    def write(self, path, steps, values):
+        raise RuntimeError('failing')
+
+
+class TestWriter:
+    def test_close(self, tmpdir):
+        logdir = pathlib.Path(tmpdir)
+        with scope.Writer(logdir, workers=4) as writer:
+            for step in range(10):
+                writer.add(step, {'foo': step})
+                writer.flush()
+            writer.add(10, {'foo': 10})
+        reader = scope.Reader(logdir)
+        steps, values = reader['foo']
+        assert (steps == np.arange(11)).all()
+        assert (values == np.arange(11)).all()
+
+    @pytest.mark.parametrize('workers', [0, 4])
+    def test_release(self, tmpdir, workers):
+        # The exit hook does not keep writers alive.
+        writer = scope.Writer(pathlib.Path(tmpdir), workers=workers)
+        writer.add(0, {'foo': 0})
+        ref = weakref.ref(writer)
+        del writer
+        gc.collect()
+        assert ref() is None
+
+    def test_block(self, tmpdir):
+        logdir = pathlib.Path(tmpdir)
+        writer = scope.Writer(
+            logdir, workers=2, formats=[SlowFloat()], queue=1
+        )
+        start = time.time()
+        for step in range(3):
+            writer.add(step, {'foo': step})
+            writer.flush()
+        assert time.time() - start >= 0.4
+        writer.close()
+        steps, _ = scope.Reader(logdir)['foo']
+        assert (steps == np.arange(3)).all()
+
+    def test_drop(self, tmpdir):
+        logdir = pathlib.Path(tmpdir)
+        writer = scope.Writer(
+            logdir, workers=1, formats=[SlowText()], queue=2, policy='drop'
+        )
+        for step in range(3):
+            writer.add(step, {'foo': 'text'})
+            writer.flush()
+        writer.close()
+        steps, _ = scope.Reader(logdir)['foo']
+        assert steps.tolist() == [0, 2]
+
+    def test_coalesce(self, tmpdir):
+        logdir = pathlib.Path(tmpdir)
+        writer = scope.Writer(
+            logdir,
+            workers=2,
+            formats=[SlowFloat()],
+            queue=1,
+            policy='coalesce',
+        )
+        start = time.time()
+        for step in range(20):
+            writer.add(step, {'foo': step})
+            writer.flush()
+        assert time.time() - start < 0.2
+        writer.wait()
+        assert time.time() - start < 1.0
+        steps, _ = scope.Reader(logdir)['foo']
+        assert (steps == np.arange(20)).all()
+
+    def test_error(self, tmpdir):
+        logdir = pathlib.Path(tmpdir)
+        writer = scope.Writer(logdir, workers=2, formats=[Failing()])
+        writer.add(0, {'foo': 1})
+        writer.flush()
+        with pytest.raises(RuntimeError):
+            writer.wait()
+        writer.add(1, {'foo': 1})
+        writer.flush()
+        with pytest.raises(RuntimeError):
+            writer.close()
+
+    def test_stats(self, tmpdir):
+        logdir = pathlib.Path(tmpdir)
+        with scope.Writer(logdir, workers=2) as writer:
+            for step in range(5):
+                image = np.zeros((8, 8, 3), np.uint8)
+                writer.add(step, {'foo': step, 'bar': image})
+                writer.flush()
+            writer.wait()
+            stats = writer.stats()
+        assert stats['add']['count'] == 5
+        assert stats['flush']['count'] == 5
+        assert stats['values'] == 10
+        assert stats['rows'] == 10
+        assert stats['columns']['foo.float']['rows'] == 5
+        assert stats['columns']['foo.float']['bytes'] == 80
+        assert 'encode' not in stats['columns']['foo.float']
+        assert stats['columns']['bar.png']['write']['count'] >= 1
+        assert stats['formats']['Image']['rows'] == 5
+        assert stats['queue'] == {'batches': 0, 'bytes': 0}
+
+    def test_stats_logging(self, tmpdir):
+        logdir = pathlib.Path(tmpdir)
+        with scope.Writer(logdir, workers=0, stats_every=1e-9) as writer:
+            with pytest.raises(ValueError):
+                writer.add(0, {'scope/foo': 1})
+            for step in range(3):
+                writer.add(step, {'foo': step})
+                writer.flush()
+        reader = scope.Reader(logdir)
+        # The final flush on close logs the stats once more.
+        steps, values = reader['scope/add_seconds']
+        assert steps.tolist() == [0, 1, 2, 2]
+        assert (values > 0).all()
+        steps, values = reader['scope/write_bytes']
+        assert values.tolist()[0] == 0
+
+    @pytest.mark.parametrize('encoder', ('thread', 'process'))
+    def test_custom_format(self, tmpdir, encoder):
+        # Formats that define write() without the encoded argument.
+        logdir = pathlib.Path(tmpdir)
+        fmts = [SlowText(), scope.formats.Float()]
+        with scope.Writer(logdir, formats=fmts, encoder=encoder) as writer:
+            writer.add(0, {'foo': 'text', 'bar': 1})
+        reader = scope.Reader(logdir)
+        _, filenames = reader['foo']
+        assert reader.load('foo', filenames[0]) == 'text'